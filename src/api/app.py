@@ -11,28 +11,61 @@ from the root directory.
 
 Then navigate to localhost:8000/api/ui to see the API documentation,
 or navigate to localhost:8000/api/<route> to see an API request result.
+
+If swagger.json has been built by precompile.py, it is loaded instead
+of swagger.yml and route handlers are imported on their first request.
+Set API_PRECOMPILED_SPEC=0 to always load swagger.yml.
+
+The per-user cache (cache.py) is enabled by starting its sales
+listener; set API_USER_CACHE=0 to disable it.
+
+This runs the Flask development server. In production, serve the app
+with gunicorn through serve.py instead.
 """
 import connexion
 import logging
-from routes import get_categories, get_products_for_category
+import os
+from precompile import SPEC_DIR, SPEC_SOURCE, LazyResolver, load_precompiled
+from src.api.cache import start_sales_listener
 from dotenv import load_dotenv
 from flask import render_template
 
-logging.basicConfig(level=logging.DEBUG)
-
 load_dotenv()
 
 PORT = 8000
 
-app = connexion.App(__name__, specification_dir="./")
-app.add_api('swagger.yml')
 
-@app.route("/")
 def home():
+    from routes import get_categories, get_products_for_category
     categories = get_categories().json
     for category in categories:
         category['products'] = get_products_for_category(category['name'])
     return render_template("home.html",categories=categories)
 
+
+def create_app(precompiled=True):
+    """Creates the Connexion app.
+
+    Args:
+        precompiled (bool): use swagger.json if it is up to date.
+
+    Returns:
+        (connexion.App) the app.
+    """
+    app = connexion.App(__name__, specification_dir=SPEC_DIR)
+    artifact = load_precompiled() if precompiled else None
+    if artifact is not None:
+        app.add_api(artifact['spec'], resolver=LazyResolver(artifact['handlers']))
+    else:
+        app.add_api(SPEC_SOURCE)
+    app.add_url_rule("/", "home", home)
+    return app
+
+
+app = create_app(precompiled=os.environ.get('API_PRECOMPILED_SPEC', '1') == '1')
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    if os.environ.get('API_USER_CACHE', '1') == '1':
+        start_sales_listener()
     app.run(host="0.0.0.0", port=PORT, debug=True)
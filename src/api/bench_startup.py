@@ -0,0 +1,71 @@
+"""Benchmarks the cold start of the API.
+
+Each run starts a fresh Python process, imports app.py and serves
+one request to a route handler through the Flask test client, so the
+handler import deferred by the precompiled spec is counted. Runs are
+repeated with the precompiled spec (swagger.json) and with swagger.yml,
+and the median times to app ready and to first response are reported.
+
+Run:
+    python src/api/precompile.py
+    python src/api/bench_startup.py [--runs 10] [--route /api/categories]
+from the root directory.
+"""
+from precompile import SPEC_DIR
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+COLD_START = """
+import json
+import time
+start = time.perf_counter()
+import logging
+logging.disable(logging.CRITICAL)
+import app
+ready = time.perf_counter()
+app.app.app.test_client().get({route!r})
+first = time.perf_counter()
+print(json.dumps({{"ready": ready - start, "first_request": first - start}}))
+"""
+
+
+def cold_start(route, precompiled):
+    """Runs one cold start in a fresh process.
+
+    Args:
+        route (str): path of the first request.
+        precompiled (bool): whether to use swagger.json.
+
+    Returns:
+        (dict) seconds to app ready and to first response.
+    """
+    env = dict(os.environ, API_PRECOMPILED_SPEC='1' if precompiled else '0',
+               API_USER_CACHE='0')
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [os.path.dirname(os.path.dirname(SPEC_DIR)), env.get('PYTHONPATH')] if p)
+    output = subprocess.run(
+        [sys.executable, '-c', COLD_START.format(route=route)],
+        cwd=SPEC_DIR, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark(runs, route):
+    """Prints median cold start timings for both spec sources."""
+    for label, precompiled in (("swagger.yml", False), ("swagger.json", True)):
+        timings = [cold_start(route, precompiled) for _ in range(runs)]
+        ready = statistics.median(t['ready'] for t in timings) * 1000
+        first = statistics.median(t['first_request'] for t in timings) * 1000
+        print(f"{label:<14} ready {ready:8.1f} ms   first request {first:8.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--route', default='/api/categories')
+    args = parser.parse_args()
+    benchmark(args.runs, args.route)
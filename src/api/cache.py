@@ -0,0 +1,225 @@
+"""Per-user cache of query results invalidated by Postgres NOTIFY.
+
+The trigger in data/sql.py (user_sales_notify_sql) notifies channel
+user_sales with a user id whenever that user's sales or details change,
+or with '*' when products or categories change. SalesListener LISTENs
+on that channel in a background thread and drops the affected entries.
+
+The cache is only used while the listener is connected and the
+trigger is installed on every table it watches; if the
+connection is lost, the cache is cleared and bypassed until the
+listener has reconnected, so results are never stale for longer than
+notification delivery. At most API_USER_CACHE_SIZE users (default
+10000) are cached per process, least recently used first out.
+
+Install the trigger with:
+    python src/data/migrate.py user_sales_notify
+from the root directory.
+
+Classes:
+    UserCache: thread-safe LRU cache of query results keyed by user.
+    SalesListener: background thread applying NOTIFY invalidations.
+
+Functions:
+    start_sales_listener: starts the listener for the shared cache.
+"""
+from collections import OrderedDict
+from src.data.sql import query_strings
+import logging
+import os
+import select
+import threading
+
+TRIGGER_TABLES = {'sales', 'users', 'products', 'categories'}
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """Thread-safe LRU cache of query results keyed by user id and query key.
+
+    Invalidations are numbered, and a result is only stored if its user
+    has not been invalidated since the query was started, so a
+    notification arriving mid-query is never lost. Only the latest
+    max_users users are remembered, both for results and invalidation
+    numbers; forgotten numbers are folded into a floor that applies to
+    every user, so a forgotten invalidation still rejects older results.
+
+    Args:
+        max_users (int): number of users whose results are kept.
+    """
+
+    def __init__(self, max_users=10000):
+        """Initialise an empty, disabled cache."""
+        self.enabled = False
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._invalidated = OrderedDict()
+        self._sequence = 0
+        self._floor = 0
+
+    def version(self, user_id):
+        """Returns the version to store a result of a query started now."""
+        with self._lock:
+            return self._sequence
+
+    def get(self, user_id, key):
+        """Returns cached result, or None if missing or cache disabled."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            results = self._entries.get(user_id)
+            if results is None:
+                return None
+            self._entries.move_to_end(user_id)
+            return results.get(key)
+
+    def set(self, user_id, key, result, version):
+        """Stores result if the user has not been invalidated since version."""
+        with self._lock:
+            if not self.enabled or self._invalidated.get(user_id, self._floor) > version:
+                return
+            self._entries.setdefault(user_id, {})[key] = result
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def invalidate(self, user_id):
+        """Drops all entries for a user."""
+        with self._lock:
+            self._sequence += 1
+            self._invalidated[user_id] = self._sequence
+            self._invalidated.move_to_end(user_id)
+            self._entries.pop(user_id, None)
+            while len(self._invalidated) > self.max_users:
+                self._forget(next(iter(self._invalidated)))
+
+    def clear(self):
+        """Drops all entries."""
+        with self._lock:
+            self._sequence += 1
+            self._floor = self._sequence
+            self._invalidated.clear()
+            self._entries.clear()
+
+    def _forget(self, user_id):
+        """Drops a user's invalidation number into the floor."""
+        number = self._invalidated.pop(user_id, None)
+        if number is not None:
+            self._floor = max(self._floor, number)
+
+
+user_cache = UserCache(int(os.environ.get('API_USER_CACHE_SIZE', 10000)))
+
+
+def _buffered(conn):
+    """Returns whether data has arrived that select on the socket misses.
+
+    pg8000 reads through a buffered file, so a notification received
+    together with the previous query's response can sit in the buffer
+    while the socket itself has nothing left to read. Peeks without
+    blocking, which also reads whatever the socket already holds.
+    """
+    usock = conn._usock
+    timeout = usock.gettimeout()
+    usock.setblocking(False)
+    try:
+        return bool(conn._sock.peek(1))
+    except OSError:
+        return False
+    finally:
+        usock.settimeout(timeout)
+
+
+class SalesListener(threading.Thread):
+    """Listens for user_sales notifications and invalidates the cache.
+
+    The connection's socket times out after heartbeat seconds, so a
+    half-open connection disables the cache within two heartbeats
+    instead of when the kernel gives up on it.
+
+    Args:
+        cache (UserCache): the cache to invalidate.
+        heartbeat (float): seconds between liveness checks of the connection.
+        retry (float): seconds to wait before reconnecting.
+    """
+
+    def __init__(self, cache, heartbeat=5.0, retry=5.0):
+        super().__init__(name="sales-listener", daemon=True)
+        self.cache = cache
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stops the listener after its current wait."""
+        self._stopped.set()
+
+    def apply(self, notifications):
+        """Invalidates the cache for drained notifications.
+
+        A full notification queue may have dropped older entries,
+        so the whole cache is cleared in that case.
+        """
+        if notifications.maxlen is not None and len(notifications) >= notifications.maxlen:
+            notifications.clear()
+            self.cache.clear()
+            return
+        while notifications:
+            _, _, payload = notifications.popleft()
+            if payload == '*':
+                self.cache.clear()
+            elif payload.isdigit():
+                self.cache.invalidate(int(payload))
+
+    def listen(self, conn):
+        """Waits for notifications on an open connection until stopped."""
+        installed = {r[0] for r in conn.run(query_strings['user_sales_triggers'])}
+        if not installed >= TRIGGER_TABLES:
+            raise RuntimeError("notify_user_sales trigger is not installed")
+        conn.run(query_strings['listen_user_sales'])
+        self.cache.clear()
+        self.cache.enabled = True
+        logger.info("User cache enabled")
+        sock = getattr(conn, '_usock', None)
+        while not self._stopped.is_set():
+            if sock is None:
+                self._stopped.wait(self.heartbeat)
+            elif not _buffered(conn):
+                select.select([sock], [], [], self.heartbeat)
+            # pg8000 reads pending notifications while handling a query
+            conn.run("SELECT 1;")
+            self.apply(conn.notifications)
+
+    def run(self):
+        from src.api.routes import get_db_connection
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = get_db_connection(timeout=self.heartbeat)
+                self.listen(conn)
+            except Exception as e:
+                logger.warning("Sales listener disconnected: %s", e)
+            finally:
+                self.cache.enabled = False
+                self.cache.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stopped.wait(self.retry)
+
+
+def start_sales_listener(cache=user_cache):
+    """Starts a SalesListener for the cache.
+
+    Returns:
+        (SalesListener) the started listener.
+    """
+    listener = SalesListener(cache)
+    listener.start()
+    return listener
+
@@ -0,0 +1,72 @@
+"""gunicorn configuration for serving the API in production.
+
+Start, reload and stop the server with serve.py. Settings can be
+overridden with the environment variables below.
+
+    API_BIND            address to listen on, default 0.0.0.0:8000
+    API_DB_CONNECTIONS  database connections one server may hold, default 45
+    API_WORKERS         worker processes, default 2 x CPUs + 1 within the budget
+    API_THREADS         threads per worker, default 4
+    API_TIMEOUT         seconds before a silent worker is restarted, default 30
+    API_WARM_TIMEOUT    seconds a new worker may spend warming up, default 10
+    API_GRACEFUL        seconds workers get to finish requests on reload, default 30
+    API_PIDFILE         master pid file, default /tmp/merch-api.pid
+
+There is no connection pool: every request thread opens its own
+database connection, and each worker also holds its cache listener's
+connection and, while capturing a slow-query plan, one more. The
+default number of workers is therefore capped so that workers x
+(threads + 2) stays within API_DB_CONNECTIONS. During a reload the old
+and new workers run side by side, so twice the budget must fit in
+Postgres' max_connections (100 by default).
+"""
+import multiprocessing
+import os
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+wsgi_app = 'wsgi:application'
+chdir = API_DIR
+pythonpath = os.path.dirname(os.path.dirname(API_DIR))
+
+bind = os.environ.get('API_BIND', '0.0.0.0:8000')
+worker_class = 'gthread'
+threads = int(os.environ.get('API_THREADS', 4))
+db_connections = int(os.environ.get('API_DB_CONNECTIONS', 45))
+workers = int(os.environ.get('API_WORKERS', max(1, min(
+    multiprocessing.cpu_count() * 2 + 1, db_connections // (threads + 2)))))
+timeout = int(os.environ.get('API_TIMEOUT', 30))
+warm_timeout = float(os.environ.get('API_WARM_TIMEOUT', 10))
+graceful_timeout = int(os.environ.get('API_GRACEFUL', 30))
+keepalive = 5
+preload_app = True
+pidfile = os.environ.get('API_PIDFILE', '/tmp/merch-api.pid')
+
+loglevel = 'info'
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    """Warms each worker before it accepts requests, then marks it ready.
+
+    Warming is cut off after API_WARM_TIMEOUT seconds, well within the
+    worker timeout, so an unreachable database cannot get the worker
+    killed before it starts.
+    """
+    from serve import write_ready_marker
+    from wsgi import warm_worker
+    warmed = warm_worker(deadline=warm_timeout)
+    server.log.info("Worker %s warmed: %s", worker.pid, warmed)
+    write_ready_marker(server.pid, worker.pid, warmed, pidfile)
+
+
+def child_exit(server, worker):
+    """Removes the ready marker of an exited or killed worker."""
+    from serve import remove_ready_markers
+    remove_ready_markers(server.pid, worker.pid, pidfile)
+
+
+def on_exit(server):
+    """Removes the ready markers of all the master's workers."""
+    from serve import remove_ready_markers
+    remove_ready_markers(server.pid, '*', pidfile)
@@ -0,0 +1,185 @@
+"""Build step and loader for the precompiled OpenAPI specification.
+
+Parsing swagger.yml (YAML plus Jinja rendering) and importing the
+route handlers are the part of the API's cold start that can be moved
+out of boot; importing connexion itself takes most of the rest. The
+build step parses and validates swagger.yml once and writes the
+result, together with the argument names of every route handler, to
+swagger.json. At boot the JSON artifact is loaded instead of the YAML
+file and the handlers are only imported when their route is first
+requested, so part of their cost moves to that first request.
+
+Run:
+    python src/api/precompile.py
+from the root directory, after any change to swagger.yml or routes.py.
+
+Classes:
+    LazyResolver: Connexion resolver returning lazily imported handlers.
+
+Functions:
+    build_spec: parses, validates and writes the precompiled spec.
+    load_precompiled: loads the precompiled spec if it is up to date.
+    lazy_handler: wraps an operationId in a lazily importing handler.
+"""
+from connexion.resolver import Resolver
+from connexion.utils import get_function_from_name
+import hashlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import yaml
+
+SPEC_DIR = os.path.dirname(os.path.abspath(__file__))
+SPEC_SOURCE = 'swagger.yml'
+SPEC_ARTIFACT = 'swagger.json'
+
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace')
+
+logger = logging.getLogger(__name__)
+
+
+def _source_digest(source_path, operation_ids):
+    """Returns sha256 hex digest of the spec and its handler modules.
+
+    The handler modules are located without importing them, so that a
+    changed handler signature makes the artifact stale at boot too.
+    """
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as source:
+        digest.update(source.read())
+    for module in sorted({operation_id.rsplit('.', 1)[0] for operation_id in operation_ids}):
+        digest.update(module.encode())
+        try:
+            with open(importlib.util.find_spec(module).origin, 'rb') as source:
+                digest.update(source.read())
+        except (AttributeError, ImportError, OSError, TypeError, ValueError):
+            digest.update(b'missing')
+    return digest.hexdigest()
+
+
+def _handler_arguments(operation_id):
+    """Returns the argument names of the handler for an operationId."""
+    parameters = inspect.signature(get_function_from_name(operation_id)).parameters
+    return [name for name, p in parameters.items()
+            if p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD)]
+
+
+def build_spec(spec_dir=SPEC_DIR, source=SPEC_SOURCE, artifact=SPEC_ARTIFACT):
+    """Parses and validates the YAML spec and writes the JSON artifact.
+
+    Route handlers are imported once here to record their arguments,
+    so that Connexion can bind parameters without importing them at boot.
+
+    Args:
+        spec_dir (str): directory containing the spec files.
+        source (str): name of the YAML spec.
+        artifact (str): name of the JSON artifact to write.
+
+    Returns:
+        (dict) the precompiled artifact.
+
+    Raises:
+        connexion.exceptions.InvalidSpecification
+    """
+    from connexion.spec import Specification
+
+    source_path = os.path.join(spec_dir, source)
+    with open(source_path) as spec_file:
+        spec = yaml.safe_load(spec_file)
+    Specification.from_dict(spec)
+
+    handlers = {}
+    for path_item in spec.get('paths', {}).values():
+        for method in HTTP_METHODS:
+            operation_id = path_item.get(method, {}).get('operationId')
+            if operation_id:
+                handlers[operation_id] = _handler_arguments(operation_id)
+
+    precompiled = {
+        "source_sha256": _source_digest(source_path, handlers),
+        "spec": spec,
+        "handlers": handlers,
+    }
+    with open(os.path.join(spec_dir, artifact), 'w') as artifact_file:
+        json.dump(precompiled, artifact_file)
+    return precompiled
+
+
+def load_precompiled(spec_dir=SPEC_DIR, source=SPEC_SOURCE, artifact=SPEC_ARTIFACT):
+    """Loads the JSON artifact if it was built from the current sources.
+
+    The artifact is stale if swagger.yml or a module defining one of
+    its handlers has changed since it was built.
+
+    Args:
+        spec_dir (str): directory containing the spec files.
+        source (str): name of the YAML spec.
+        artifact (str): name of the JSON artifact.
+
+    Returns:
+        (dict) the precompiled artifact, or None if it is missing or stale.
+    """
+    artifact_path = os.path.join(spec_dir, artifact)
+    if not os.path.exists(artifact_path):
+        return None
+    with open(artifact_path) as artifact_file:
+        precompiled = json.load(artifact_file)
+    digest = _source_digest(os.path.join(spec_dir, source), precompiled.get('handlers', {}))
+    if precompiled.get('source_sha256') != digest:
+        logger.warning("%s is stale, falling back to %s", artifact, source)
+        return None
+    return precompiled
+
+
+def lazy_handler(operation_id, arguments):
+    """Wraps an operationId in a handler that imports it on first call.
+
+    The wrapper carries the recorded signature of the real handler, so
+    Connexion passes it exactly the same parameters.
+
+    Args:
+        operation_id (str): dotted name of the handler, e.g. routes.get_users
+        arguments (list): argument names of the handler.
+
+    Returns:
+        (function) the lazy handler.
+    """
+    target = None
+
+    def handler(*args, **kwargs):
+        nonlocal target
+        if target is None:
+            target = get_function_from_name(operation_id)
+        return target(*args, **kwargs)
+
+    handler.__name__ = operation_id.rsplit('.', 1)[-1]
+    handler.__qualname__ = handler.__name__
+    handler.__signature__ = inspect.Signature([
+        inspect.Parameter(name, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+        for name in arguments
+    ])
+    return handler
+
+
+class LazyResolver(Resolver):
+    """Resolves operationIds recorded in the artifact to lazy handlers.
+
+    Unknown operationIds are resolved by importing them, as usual.
+    """
+
+    def __init__(self, handlers):
+        """Initialise with operationId to argument names mapping."""
+        super().__init__()
+        self.handlers = handlers
+
+    def resolve_function_from_operation_id(self, operation_id):
+        if operation_id in self.handlers:
+            return lazy_handler(operation_id, self.handlers[operation_id])
+        return super().resolve_function_from_operation_id(operation_id)
+
+
+if __name__ == '__main__':
+    build_spec()
+    print(f"Wrote {os.path.join(SPEC_DIR, SPEC_ARTIFACT)}")
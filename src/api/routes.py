@@ -10,9 +10,12 @@ Classes:
 Functions:
     get_db_connection: returns pg8000 Native Connection.
     process_query: helper function to execute supplied SQL.
+    process_user_query: process_query through the per-user cache.
     get_categories: handles the /categories route.
     get_products: handles the /products route.
     get_product: handles the /products/{product_id} route.
+    search_products: handles the /products/search route.
+    get_related_products: handles the /products/{product_id}/related route.
     get_users: handles the /users route.
     get_user_sales: handles the /users/{user_id}/sales route.
     get_user_sales_latest: handles the /users/{user_id}/sales/latest route.
@@ -21,8 +24,11 @@ Functions:
 """
 from pg8000.native import Connection, Error, DatabaseError
 from flask import jsonify, abort
-from src.data.sql import query_strings
+from src.data.sql import query_strings, projected_query, projected_keys
+from src.api.cache import user_cache
+from src.api.slowlog import slow_query_log
 import os
+import time
 
 
 class DBConnectionException(Exception):
@@ -34,10 +40,15 @@ class DBConnectionException(Exception):
         super().__init__(self.message)
 
 
-def get_db_connection():
+def get_db_connection(timeout=None):
     """Gets a pg8000.native Connection to the database.
 
-    Credentials are retrieved from environment variables.
+    Credentials are retrieved from environment variables. DB_TIMEOUT
+    optionally limits, in seconds, how long connecting or waiting on
+    the socket may block.
+
+    Args:
+        timeout (float): socket timeout in seconds, default DB_TIMEOUT.
 
     Returns:
         (pg8000.native.Connection): a database connection
@@ -51,24 +62,31 @@ def get_db_connection():
         DB_USER = os.environ['DB_USER']
         DB_PASSWORD = os.environ['DB_PASSWORD']
         DB_DB = os.environ['DB_DB']
+        DB_TIMEOUT = os.environ.get('DB_TIMEOUT')
+        if timeout is None and DB_TIMEOUT:
+            timeout = float(DB_TIMEOUT)
         return Connection(
             host=DB_HOST,
             user=DB_USER,
             port=DB_PORT,
             password=DB_PASSWORD,
-            database=DB_DB
+            database=DB_DB,
+            timeout=timeout
         )
     except (Error, DatabaseError) as e:
         raise DBConnectionException(e)
 
 
-def process_query(query, **kwargs):
+def process_query(query, sort_by_id=True, **kwargs):
     """Gets a connection, executes a query, closes connection.
 
     Pass in a valid query string and any query parameters.
+    Slow queries are recorded in the slow-query log (slowlog.py).
 
     Args:
         query (string): a valid SQL query.
+        sort_by_id (bool): sort rows by id if they have one, otherwise
+            keep the order returned by the query.
 
     Keyword Arguments:
         kwargs: a tuple of SQL parameters e.g. user_id=3
@@ -89,19 +107,50 @@ def process_query(query, **kwargs):
 
     try:
         conn = get_db_connection()
+        start = time.perf_counter()
         result = conn.run(query, **kwargs)
+        duration = time.perf_counter() - start
         columns = [c['name'] for c in conn.columns]
     except DBConnectionException as e:
         raise RuntimeError(e)
     finally:
         conn.close()
+    slow_query_log.observe(query, kwargs, len(result), duration, get_db_connection)
     result_dict = [dict(zip(columns, r)) for r in result]
-    if len(result_dict) > 0:
+    if len(result_dict) > 0 and sort_by_id:
         result_sorted = sorted(result_dict, key=lambda r: r['id']) if 'id' in result_dict[0] else result_dict
     else:
         result_sorted = result_dict
     return jsonify(result_sorted)
 
+
+def process_user_query(user_id, key, fields=None, **kwargs):
+    """Executes a per-user query, serving repeats from the user cache.
+
+    Entries are invalidated by the sales listener in cache.py; while
+    it is not connected the cache is bypassed.
+
+    Args:
+        user_id (int): the id of the user.
+        key (string): key of the query in query_strings.
+        fields (list): fields to select, for queries in sql.projections.
+
+    Keyword Arguments:
+        kwargs: further SQL parameters.
+
+    Returns:
+        (Response) a response containing jsonified query results.
+    """
+    query = projected_query(key, fields) if fields else query_strings[key]
+    cache_key = projected_keys.get(query, key)
+    cached = user_cache.get(user_id, cache_key)
+    if cached is not None:
+        return jsonify(cached)
+    version = user_cache.version(user_id)
+    result = process_query(query, user_id=user_id, **kwargs)
+    user_cache.set(user_id, cache_key, result.json, version)
+    return result
+
 def get_categories():
     """Gets list of all product categories.
 
@@ -130,11 +179,14 @@ def create_category(category):
     # print(f"check: {category}")
     return {"response":200, "message":"successfully created category"}
 
-def get_products():
+def get_products(fields=None):
     """Gets list of all products with named category.
 
     If no products, returns empty list.
 
+    Args:
+        fields (list): fields to return, default all.
+
     Returns:
         (Response) Result of query.
 
@@ -149,7 +201,7 @@ def get_products():
             }
         ]
     """
-    query = query_strings['products']
+    query = projected_query('products', fields)
     return process_query(query)
 
 def get_products_for_category(category_name, sort='title'):
@@ -234,13 +286,84 @@ def get_product(product_id):
         #            "query_error": "Product does not exist"})
 
 
-def get_users():
+def search_products(q, category=None, min_cost=None, max_cost=None, limit=20, offset=0):
+    """Searches products by title and description.
+
+    Matches are found by full-text search over title and description,
+    or by trigram similarity to the title, and are ordered by rank.
+
+    Args:
+        q (str): search terms, in web search syntax.
+        category (str): only return products in this category.
+        min_cost (float): only return products costing at least this.
+        max_cost (float): only return products costing at most this.
+        limit (int): maximum number of products to return.
+        offset (int): number of ranked products to skip.
+
+    Returns:
+        (Response) Result of query.
+
+        Example:
+        [
+            {
+                "id": 5,
+                "title": "Car",
+                "description": "Nice",
+                "cost": 101.00,
+                "category": "Movies",
+                "rank": 1.06
+            }
+        ]
+    """
+    query = query_strings['product_search']
+    return process_query(query, sort_by_id=False, q=q, category=category,
+                         min_cost=min_cost, max_cost=max_cost,
+                         limit=limit, offset=offset)
+
+
+def get_related_products(product_id, limit=10):
+    """Gets products most often bought by buyers of a product.
+
+    Served from the co-purchase index built by data/related.py. If no
+    such product, returns error response.
+
+    Args:
+        product_id (int): the identifier for the product.
+        limit (int): maximum number of products to return.
+
+    Returns:
+        (Response) Result of query (if id exists) or error message
+
+        Example:
+        [
+            {
+                "id": 7,
+                "title": "Sausages",
+                "cost": 978.00,
+                "category": "Baby",
+                "buyers": 12
+            }
+        ]
+        {"id": 111, "query_error": "Product does not exist"}
+    """
+    query = query_strings['related_products']
+    related = process_query(query, sort_by_id=False, product_id=product_id, limit=limit)
+    if len(related.json) == 0 and 'query_error' in get_product(product_id).json:
+        return jsonify({"id": product_id,
+                        "query_error": "Product does not exist"})
+    return related
+
+
+def get_users(fields=None):
     """Gets list of all users.
 
     Returns list of users excluding important contact details,
     for example email and phone number. If no users, returns
     empty list.
 
+    Args:
+        fields (list): fields to return, default all.
+
     Returns:
         (Response) Result of query.
 
@@ -258,7 +381,7 @@ def get_users():
             }
         ]
     """
-    query = query_strings['all_users']
+    query = projected_query('all_users', fields)
     return process_query(query)
 
 def get_user_by_id(user_id):
@@ -273,8 +396,7 @@ def get_user_by_id(user_id):
         user_id=1 : {"id": 1, "first_name": "John", "last_name": "Smith"}
         user_id=111: {"id": 111, "query_error": "User does not exist"}
     """
-    query = query_strings['user_by_id']
-    user_data = process_query(query, user_id=user_id)
+    user_data = process_user_query(user_id, 'user_by_id')
     if len(user_data.json) > 0:
         return user_data
     else:
@@ -282,7 +404,7 @@ def get_user_by_id(user_id):
                         "query_error": "User does not exist"})
     
 
-def get_user_sales(user_id, date_from, date_to):
+def get_user_sales(user_id, date_from, date_to, fields=None):
     """Gets sales for specific user between two dates .
 
     Returns error response if user does not exist. Returns
@@ -293,6 +415,7 @@ def get_user_sales(user_id, date_from, date_to):
         user_id (int): valid user identifier
         date_from (str): date in format yyyy-mm-dd
         date_to (str): date in format yyyy-mm-dd
+        fields (list): fields to return, default all.
 
     Returns:
         (Response) Result of query, or
@@ -312,12 +435,12 @@ def get_user_sales(user_id, date_from, date_to):
     user_check = get_user_by_id(user_id)
     if 'query_error' in user_check.json:
         return jsonify({"user_id": user_id, "query_error": "User does not exist"})
-    query = query_strings['user_sales']
+    query = projected_query('user_sales', fields)
     sales_data = process_query(query, user_id=user_id, date_from=date_from, date_to=date_to)   
     return sales_data
 
 
-def get_user_sales_latest(user_id):
+def get_user_sales_latest(user_id, fields=None):
     """Gets latest sales for user up to maximum of five.
 
     Returns error response if user does not exist. Returns
@@ -326,6 +449,7 @@ def get_user_sales_latest(user_id):
 
     Args:
         user_id (int): valid user identifier
+        fields (list): fields to return, default all.
 
     Returns:
         (Response) Result of query, or
@@ -344,6 +468,5 @@ def get_user_sales_latest(user_id):
     user_check = get_user_by_id(user_id)
     if 'query_error' in user_check.json:
         return jsonify({"user_id": user_id, "query_error": "User does not exist"})
-    query = query_strings['user_sales_latest']
-    sales_data = process_query(query, user_id=user_id)   
+    sales_data = process_user_query(user_id, 'user_sales_latest', fields)
     return sales_data
\ No newline at end of file
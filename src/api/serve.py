@@ -0,0 +1,165 @@
+"""Starts, gracefully reloads and stops the production server.
+
+The server is gunicorn configured by gunicorn.conf.py. As the app is
+preloaded, a plain HUP would restart the workers from the master's old
+code, so reload does a zero-downtime upgrade instead: USR2 starts a
+new master with the new code next to the old one. Each new worker
+writes a ready marker next to the pid file once it has warmed up,
+recording the status of every warm-up request, and only when all of
+them have, with every request answered 200, does TERM make the old
+master stop
+accepting connections and let its workers drain in-flight requests
+for up to graceful_timeout. If they do not, or any warm-up failed, the
+new master is stopped and the old server keeps running.
+
+Run:
+    python src/api/serve.py start|reload|stop
+from the root directory.
+
+Functions:
+    start: replaces this process with the gunicorn master.
+    reload: upgrades a running server to the current code.
+    stop: gracefully stops a running server.
+    write_ready_marker: marks a worker as warmed and ready.
+    failed_warm_ups: reads a master's ready markers and failed warm-ups.
+    remove_ready_markers: removes the markers of exited workers.
+"""
+import argparse
+import glob
+import json
+import os
+import runpy
+import signal
+import time
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(API_DIR, 'gunicorn.conf.py')
+PIDFILE = os.environ.get('API_PIDFILE', '/tmp/merch-api.pid')
+
+
+def read_pid(pidfile=PIDFILE):
+    """Returns the pid in pidfile, or None if there is none."""
+    try:
+        with open(pidfile) as pid_file:
+            return int(pid_file.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _ready_marker(master_pid, worker_pid, pidfile=PIDFILE):
+    return f"{pidfile}.{master_pid}.{worker_pid}.ready"
+
+
+def write_ready_marker(master_pid, worker_pid, warmed, pidfile=PIDFILE):
+    """Marks a worker of a master as warmed, recording its warm-up results.
+
+    The marker is written to a temporary file and renamed, so reload
+    never reads a partial one.
+    """
+    path = _ready_marker(master_pid, worker_pid, pidfile)
+    with open(path + '.tmp', 'w') as marker:
+        json.dump(warmed, marker)
+    os.replace(path + '.tmp', path)
+
+
+def failed_warm_ups(master_pid, pidfile=PIDFILE):
+    """Returns the ready markers of a master's workers and their failures.
+
+    Returns:
+        (tuple) number of ready workers, and a list of the warm-up
+        requests, with their results, that did not return 200.
+    """
+    paths = glob.glob(_ready_marker(master_pid, '*', glob.escape(pidfile)))
+    failed = []
+    for path in paths:
+        with open(path) as marker:
+            warmed = json.load(marker)
+        failed.extend(f"{route}: {result}" for route, result in warmed.items() if result != 200)
+    return len(paths), failed
+
+
+def remove_ready_markers(master_pid, worker_pid='*', pidfile=PIDFILE):
+    """Removes the ready markers of a worker, or with '*' of all workers."""
+    for path in glob.glob(_ready_marker(master_pid, worker_pid, glob.escape(pidfile))):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def configured_workers():
+    """Returns the number of workers set by gunicorn.conf.py."""
+    return runpy.run_path(CONFIG)['workers']
+
+
+def start():
+    """Replaces this process with the gunicorn master.
+
+    The gunicorn script is run rather than python -m gunicorn, as the
+    master re-executes its own command line on reload.
+    """
+    os.execvp('gunicorn', ['gunicorn', '-c', CONFIG])
+
+
+def reload(workers=None, timeout=60.0, pidfile=PIDFILE):
+    """Upgrades a running server to the current code without downtime.
+
+    Args:
+        workers (int): new workers to wait for, default as configured.
+        timeout (float): seconds to wait for the new master and workers.
+
+    Raises:
+        RuntimeError if no server is running or the new master or its
+        workers fail to start, in which case the old server is kept.
+    """
+    old_pid = read_pid(pidfile)
+    if old_pid is None:
+        raise RuntimeError(f"No server running, {pidfile} not found")
+    workers = workers or configured_workers()
+    os.kill(old_pid, signal.SIGUSR2)
+    # the new master writes pidfile.2 until the old master has exited
+    deadline = time.monotonic() + timeout
+    new_pid = None
+    while new_pid is None:
+        if time.monotonic() > deadline:
+            raise RuntimeError("New master did not start, old server kept running")
+        time.sleep(0.2)
+        new_pid = read_pid(pidfile + '.2')
+    while True:
+        ready, failed = failed_warm_ups(new_pid, pidfile)
+        if failed or (ready < workers and time.monotonic() > deadline):
+            try:
+                os.kill(new_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            reason = f"failed {', '.join(sorted(set(failed)))}" if failed else "did not warm up"
+            raise RuntimeError(f"New workers {reason}, old server kept running")
+        if ready >= workers:
+            break
+        time.sleep(0.2)
+    os.kill(old_pid, signal.SIGTERM)
+    return new_pid
+
+
+def stop(pidfile=PIDFILE):
+    """Gracefully stops a running server, draining in-flight requests."""
+    pid = read_pid(pidfile)
+    if pid is None:
+        raise RuntimeError(f"No server running, {pidfile} not found")
+    os.kill(pid, signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the API with gunicorn.")
+    parser.add_argument('command', choices=['start', 'reload', 'stop'])
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help="seconds new workers get to warm up on reload")
+    parser.add_argument('--workers', type=int,
+                        help="new workers to wait for on reload, default as configured")
+    args = parser.parse_args()
+    if args.command == 'start':
+        start()
+    elif args.command == 'reload':
+        print(f"Reloaded, new master {reload(workers=args.workers, timeout=args.timeout)}")
+    else:
+        stop()
@@ -0,0 +1,283 @@
+"""Sampled slow-query log for process_query.
+
+Queries slower than SLOW_QUERY_MS milliseconds are logged with their
+query_strings key, redacted parameters, row count and duration. For a
+SLOW_QUERY_SAMPLE fraction of them, the query is re-run under
+EXPLAIN (ANALYZE, BUFFERS) on a separate connection in a background
+thread and the plan is stored with the entry. At most one plan is
+captured at a time per process, and each query key at most once every
+SLOW_QUERY_PLAN_INTERVAL seconds, so a slow database is not loaded
+further. The plan runs in a read-only transaction that is rolled back,
+and literal values in its conditions are replaced by '?'.
+
+Entries are written as JSON lines next to SLOW_QUERY_LOG, by default
+slow_queries.jsonl in the root directory, one file per process named
+with its pid (slow_queries.<pid>.jsonl) as rotating a shared file from
+several gunicorn workers loses entries. Each file is rotated every
+SLOW_QUERY_LOG_BYTES bytes. Failures to log are only reported as
+warnings, the query result is still returned.
+
+Run:
+    python src/api/slowlog.py [--top 10] [--plans KEY]
+from the root directory to summarise the slowest queries.
+
+Classes:
+    SlowQueryLog: records slow queries and captures their plans.
+
+Functions:
+    query_key: returns the query_strings key of a query.
+    redact: replaces parameter values by their type names.
+    scrub_plan: replaces literal values in plan conditions.
+    process_log_path: returns the log file of a process.
+    read_entries: reads entries from every process's log and backups.
+    summarise: aggregates entries by query key.
+"""
+from logging.handlers import RotatingFileHandler
+from src.data.sql import query_strings, projected_keys
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Plan lines which print the query's values once they are bound
+PLAN_CONDITIONS = ('Index Cond:', 'Recheck Cond:', 'Filter:', 'Join Filter:',
+                   'Hash Cond:', 'Merge Cond:', 'One-Time Filter:', 'Order By:')
+PLAN_LITERAL = re.compile(r"'(?:[^']|'')*'|(?<![\w.$])-?\d+(?:\.\d+)?(?![\w.])")
+
+logger = logging.getLogger(__name__)
+
+_query_keys = {query: key for key, query in query_strings.items()}
+
+
+def query_key(query):
+    """Returns the query_strings key of a query, or its first line.
+
+    Projections are keyed with their fields, e.g. products[id,title].
+    """
+    return (_query_keys.get(query) or projected_keys.get(query)
+            or query.strip().splitlines()[0][:60])
+
+
+def redact(params):
+    """Replaces parameter values by their type names."""
+    return {name: type(value).__name__ for name, value in params.items()}
+
+
+def scrub_plan(plan):
+    """Replaces string and number literals in plan conditions by '?'.
+
+    Custom plans print bound parameters inline, e.g. Index Cond: (id = 3).
+    Costs, timings and row counts on the other lines are kept.
+    """
+    lines = []
+    for line in plan.splitlines():
+        label = line.lstrip().lstrip('->').lstrip()
+        if label.startswith(PLAN_CONDITIONS):
+            head, condition = line.split(':', 1)
+            line = head + ':' + PLAN_LITERAL.sub(
+                lambda m: "'?'" if m.group(0).startswith("'") else '?', condition)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def process_log_path(path, pid):
+    """Returns the log file of process pid, e.g. slow_queries.123.jsonl."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{pid}{ext}"
+
+
+class SlowQueryLog:
+    """Records slow queries and captures a sample of their plans.
+
+    Args:
+        path (str): log file, each process writes to its process_log_path.
+        threshold_ms (float): duration above which a query is slow.
+        sample_rate (float): fraction of slow queries to EXPLAIN.
+        max_bytes (int): size at which the file is rotated.
+        backups (int): number of rotated files to keep.
+        plan_interval (float): minimum seconds between plans of a query key.
+    """
+
+    def __init__(self, path, threshold_ms=200, sample_rate=0.1,
+                 max_bytes=5_000_000, backups=3, plan_interval=60.0):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.plan_interval = plan_interval
+        self._handler = None
+        self._handler_pid = None
+        self._lock = threading.Lock()
+        self._plan_slot = threading.Semaphore(1)
+        self._planned = {}
+
+    def write(self, entry):
+        """Appends an entry to this process's log file, warning if that fails.
+
+        The file is opened on first write in each process, so forked
+        workers never share the master's handler.
+        """
+        try:
+            with self._lock:
+                if self._handler_pid != os.getpid():
+                    self._handler_pid = os.getpid()
+                    self._handler = RotatingFileHandler(
+                        process_log_path(self.path, self._handler_pid),
+                        maxBytes=self.max_bytes, backupCount=self.backups)
+                self._handler.emit(logging.makeLogRecord({'msg': json.dumps(entry, default=str)}))
+        except Exception as e:
+            logger.warning("Could not write slow query log %s: %s", self.path, e)
+
+    def explain(self, entry, query, params, connect):
+        """Re-runs query under EXPLAIN (ANALYZE, BUFFERS) and writes entry.
+
+        The query runs in a read-only transaction which is rolled back,
+        so a data-modifying statement fails instead of being applied.
+        Releases the plan slot taken by observe.
+        """
+        conn = None
+        try:
+            conn = connect()
+            conn.run("START TRANSACTION READ ONLY;")
+            try:
+                plan = conn.run('EXPLAIN (ANALYZE, BUFFERS) ' + query.strip(), **params)
+            finally:
+                conn.run("ROLLBACK;")
+            entry['plan'] = scrub_plan('\n'.join(row[0] for row in plan))
+        except Exception as e:
+            entry['plan_error'] = str(e)
+        finally:
+            self._plan_slot.release()
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        self.write(entry)
+
+    def _take_plan_slot(self, key):
+        """Returns whether a plan of key may be captured now."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._planned.get(key, -self.plan_interval) < self.plan_interval:
+                return False
+            if not self._plan_slot.acquire(blocking=False):
+                return False
+            self._planned[key] = now
+            return True
+
+    def observe(self, query, params, rows, duration, connect):
+        """Records a query if it was slow.
+
+        Args:
+            query (string): the SQL that was run.
+            params (dict): its parameters.
+            rows (int): number of rows returned.
+            duration (float): seconds taken.
+            connect (function): returns a new database connection.
+
+        Returns:
+            (Thread) the thread capturing the plan, if one was started.
+        """
+        duration_ms = duration * 1000
+        if duration_ms < self.threshold_ms:
+            return None
+        try:
+            entry = {
+                "ts": time.time(),
+                "query": query_key(query),
+                "params": redact(params),
+                "rows": rows,
+                "duration_ms": round(duration_ms, 1),
+            }
+            logger.warning("Slow query %s: %.1f ms, %d rows, params %s",
+                           entry['query'], duration_ms, rows, entry['params'])
+            sql = query.lstrip().lower()
+            if (random.random() < self.sample_rate and sql.startswith(('select', 'with'))
+                    and self._take_plan_slot(entry['query'])):
+                thread = threading.Thread(target=self.explain,
+                                          args=(entry, query, params, connect), daemon=True)
+                try:
+                    thread.start()
+                except Exception:
+                    self._plan_slot.release()
+                    raise
+                return thread
+        except Exception as e:
+            logger.warning("Could not record slow query: %s", e)
+            return None
+        self.write(entry)
+        return None
+
+
+slow_query_log = SlowQueryLog(
+    os.path.join(ROOT_DIR, os.environ.get('SLOW_QUERY_LOG', 'slow_queries.jsonl')),
+    threshold_ms=float(os.environ.get('SLOW_QUERY_MS', 200)),
+    sample_rate=float(os.environ.get('SLOW_QUERY_SAMPLE', 0.1)),
+    max_bytes=int(os.environ.get('SLOW_QUERY_LOG_BYTES', 5_000_000)),
+    plan_interval=float(os.environ.get('SLOW_QUERY_PLAN_INTERVAL', 60)),
+)
+
+
+def read_entries(path):
+    """Reads entries from the log files of every process and their backups."""
+    root, ext = os.path.splitext(path)
+    log_file_name = re.compile(re.escape(root) + r'(\.\d+)?' + re.escape(ext) + r'(\.\d+)?')
+    entries = []
+    for file_path in sorted(glob.glob(glob.escape(root) + '*')):
+        if not log_file_name.fullmatch(file_path):
+            continue
+        with open(file_path) as log_file:
+            entries.extend(json.loads(line) for line in log_file if line.strip())
+    return entries
+
+
+def summarise(entries):
+    """Aggregates entries by query key, slowest total time first.
+
+    Returns:
+        (list) of dicts with query, count, total_ms, mean_ms, max_ms,
+        max_rows and plans (number of captured plans).
+    """
+    summary = {}
+    for entry in entries:
+        item = summary.setdefault(entry['query'], {
+            "query": entry['query'], "count": 0, "total_ms": 0.0,
+            "max_ms": 0.0, "max_rows": 0, "plans": 0
+        })
+        item['count'] += 1
+        item['total_ms'] += entry['duration_ms']
+        item['max_ms'] = max(item['max_ms'], entry['duration_ms'])
+        item['max_rows'] = max(item['max_rows'], entry['rows'])
+        item['plans'] += 'plan' in entry
+    for item in summary.values():
+        item['mean_ms'] = round(item['total_ms'] / item['count'], 1)
+        item['total_ms'] = round(item['total_ms'], 1)
+    return sorted(summary.values(), key=lambda r: r['total_ms'], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise the slow-query log.")
+    parser.add_argument('--log', default=slow_query_log.path)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--plans', metavar='KEY', help="print captured plans for a query key")
+    args = parser.parse_args()
+    entries = read_entries(args.log)
+    if args.plans:
+        for entry in entries:
+            if entry['query'] == args.plans and 'plan' in entry:
+                print(f"-- {time.ctime(entry['ts'])}, {entry['duration_ms']} ms, params {entry['params']}")
+                print(entry['plan'], end='\n\n')
+    else:
+        print(f"{'query':<24}{'count':>7}{'total ms':>12}{'mean ms':>10}{'max ms':>10}{'rows':>8}{'plans':>7}")
+        for item in summarise(entries)[:args.top]:
+            print(f"{item['query']:<24}{item['count']:>7}{item['total_ms']:>12}"
+                  f"{item['mean_ms']:>10}{item['max_ms']:>10}{item['max_rows']:>8}{item['plans']:>7}")
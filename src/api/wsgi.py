@@ -0,0 +1,63 @@
+"""WSGI entry point for serving the API in production.
+
+Loaded by gunicorn (see gunicorn.conf.py and serve.py). With app
+preloading the app and the route handlers are imported once in the
+gunicorn master and shared by the forked workers; each worker then
+calls warm_worker before it accepts requests.
+
+Functions:
+    create_wsgi_app: returns the WSGI app.
+    warm_worker: opens a worker's connections and primes its queries.
+"""
+from app import app
+from src.api.cache import start_sales_listener
+import os
+import routes  # noqa: F401, imported before forking so workers share it
+import threading
+
+# Catalog routes requested once by every worker before it accepts traffic;
+# products only selects ids, the whole catalog is not worth fetching.
+WARM_ROUTES = ['/api/categories', '/api/products?fields=id']
+
+
+def create_wsgi_app():
+    """Returns the Flask WSGI app wrapped by the Connexion app."""
+    return app.app
+
+
+application = create_wsgi_app()
+
+
+def warm_worker(deadline=10.0):
+    """Prepares a freshly forked worker to serve requests.
+
+    Starts the sales listener, which holds the worker's database
+    connection for the per-user cache, and requests the catalog routes
+    once so their first real request does not pay for the database
+    round trip, the spec validators and JSON encoding warm-up.
+    The routes are requested in a background thread which is given up
+    on after deadline seconds, so a hanging database cannot stall the
+    worker. Failures are reported, the worker still starts.
+
+    Args:
+        deadline (float): seconds to wait for the warm-up requests.
+
+    Returns:
+        (dict) response status, or error message, per warmed route.
+    """
+    if os.environ.get('API_USER_CACHE', '1') == '1':
+        start_sales_listener()
+    client = application.test_client()
+    warmed = {route: "timed out" for route in WARM_ROUTES}
+
+    def warm():
+        for route in WARM_ROUTES:
+            try:
+                warmed[route] = client.get(route).status_code
+            except Exception as e:
+                warmed[route] = str(e)
+
+    thread = threading.Thread(target=warm, name="warm-worker", daemon=True)
+    thread.start()
+    thread.join(deadline)
+    return dict(warmed)
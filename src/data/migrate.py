@@ -0,0 +1,48 @@
+"""Applies the database migrations defined in data/sql.py.
+
+Every migration is idempotent, so it is safe to re-run them all.
+Indexes on large tables are built CONCURRENTLY, one statement at a
+time, so they do not block writes. If such a build fails it leaves an
+INVALID index behind, which IF NOT EXISTS would skip: drop it and
+re-run the migration.
+
+Run:
+    python src/data/migrate.py [name ...]
+from the root directory. With no names, all migrations are applied.
+
+Functions:
+    apply_migrations: runs the named migrations against the database.
+"""
+from src.data.sql import migrations
+import sys
+
+
+def apply_migrations(names=None):
+    """Runs migrations in a single connection.
+
+    A migration given as a list is run one statement at a time, each
+    outside any transaction.
+
+    Args:
+        names (list): names of migrations to run, default all.
+
+    Raises:
+        KeyError if a name is not a known migration.
+    """
+    from src.api.routes import get_db_connection
+    names = names or list(migrations)
+    statements = [migrations[name] for name in names]
+    conn = get_db_connection()
+    try:
+        for name, statement in zip(names, statements):
+            for step in ([statement] if isinstance(statement, str) else statement):
+                conn.run(step)
+            print(f"Applied {name}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    apply_migrations(sys.argv[1:])
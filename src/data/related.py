@@ -0,0 +1,197 @@
+"""Builds the "customers also bought" index served by /products/{id}/related.
+
+The index counts, for every pair of products, the distinct buyers who
+bought both (product_pairs), and keeps the TOP_K most co-purchased
+products per product (related_products), so the route is a single
+primary key lookup.
+
+Every new sale is queued in related_pending_sales by a trigger in the
+transaction inserting it, so it reaches the queue when it commits,
+even if a sale with a higher id committed first. rebuild recounts the
+whole sales history except the queued sales, one range of buyers per
+statement, so neither Python nor Postgres holds more than a batch of
+buyers' purchases at a time. refresh drains the queue in batches,
+adding each batch's sales and re-ranking only the products they touch.
+Sales are assumed to be append-only; deleted or updated sales are only
+corrected by the next rebuild. Both take an advisory lock, so runs
+never overlap. follow reconnects with backoff when its connection is
+lost.
+
+Run:
+    python src/data/related.py rebuild [--batch 1000]
+    python src/data/related.py refresh [--follow]
+from the root directory, after applying the migrations.
+
+Functions:
+    rebuild: recounts the index from the whole sales history.
+    refresh: adds new sales to the index.
+    follow: refreshes whenever sales change, until interrupted.
+"""
+from src.api.cache import _buffered
+from src.data.sql import related_index_sql as sql, query_strings
+import argparse
+import logging
+import select
+import time
+
+TOP_K = 20
+REBUILD_BATCH = 1000
+REFRESH_BATCH = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def _connect():
+    from src.api.routes import get_db_connection
+    return get_db_connection()
+
+
+def rebuild(conn, batch=REBUILD_BATCH, top_k=TOP_K):
+    """Recounts the index from all counted sales, in batches of buyers.
+
+    Sales still queued are left for refresh. The served top products
+    are only replaced, in one transaction, once the recount has finished.
+
+    Args:
+        conn (pg8000.native.Connection): a database connection.
+        batch (int): number of buyer ids per batch.
+        top_k (int): number of related products kept per product.
+    """
+    conn.run(sql['lock'])
+    try:
+        conn.run(sql['clear_built'])
+        conn.run(sql['clear_pairs'])
+        buyer_min, buyer_max = conn.run(sql['buyer_range'])[0]
+        if buyer_min is not None:
+            for buyer_from in range(buyer_min, buyer_max + 1, batch):
+                conn.run(sql['count_buyer_batch'], buyer_from=buyer_from,
+                         buyer_to=buyer_from + batch)
+        conn.run(sql['begin'])
+        try:
+            conn.run(sql['clear_top'])
+            conn.run(sql['rank_top'], top_k=top_k)
+            conn.run(sql['set_built'])
+            conn.run(sql['commit'])
+        except Exception:
+            conn.run(sql['rollback'])
+            raise
+    finally:
+        conn.run(sql['unlock'])
+
+
+def refresh(conn, batch=REFRESH_BATCH, top_k=TOP_K):
+    """Adds the queued sales to the index.
+
+    Each batch of sales is taken off the queue, counted and re-ranked
+    in one transaction, so a failed run can simply be repeated.
+
+    Args:
+        conn (pg8000.native.Connection): a database connection.
+        batch (int): number of sales per transaction.
+        top_k (int): number of related products kept per product.
+
+    Returns:
+        (int) number of sales counted.
+
+    Raises:
+        RuntimeError if the index has not been built by rebuild.
+    """
+    conn.run(sql['lock'])
+    try:
+        if not conn.run(sql['built']):
+            raise RuntimeError("related products index missing, run rebuild first")
+        counted = 0
+        while True:
+            conn.run(sql['begin'])
+            try:
+                sale_ids = [r[0] for r in conn.run(sql['drain_pending'], batch=batch)]
+                if sale_ids:
+                    rows = conn.run(sql['count_new_sales'], sale_ids=sale_ids)
+                    product_ids = sorted({r[0] for r in rows})
+                    if product_ids:
+                        conn.run(sql['clear_top_for'], product_ids=product_ids)
+                        conn.run(sql['rank_top_for'], product_ids=product_ids, top_k=top_k)
+                conn.run(sql['commit'])
+            except Exception:
+                conn.run(sql['rollback'])
+                raise
+            counted += len(sale_ids)
+            if len(sale_ids) < batch:
+                return counted
+    finally:
+        conn.run(sql['unlock'])
+
+
+def follow(connect=_connect, heartbeat=60.0, top_k=TOP_K, retry=1.0, max_retry=60.0):
+    """Refreshes on every user_sales notification, until interrupted.
+
+    Uses the notifications of the user cache trigger; without it the
+    index is still refreshed every heartbeat seconds. If the connection
+    fails, a new one is opened after retry seconds, doubling up to
+    max_retry while it keeps failing.
+
+    Args:
+        connect (function): returns a new database connection.
+        heartbeat (float): maximum seconds between refreshes.
+        top_k (int): number of related products kept per product.
+        retry (float): seconds to wait before the first reconnect.
+        max_retry (float): maximum seconds to wait between reconnects.
+
+    Raises:
+        RuntimeError if the index has not been built by rebuild.
+    """
+    delay = retry
+    while True:
+        conn = None
+        try:
+            conn = connect()
+            conn.run(query_strings['listen_user_sales'])
+            sock = getattr(conn, '_usock', None)
+            while True:
+                conn.notifications.clear()
+                refresh(conn, top_k=top_k)
+                delay = retry
+                if conn.notifications:
+                    continue
+                if sock is None:
+                    time.sleep(heartbeat)
+                elif not _buffered(conn):
+                    select.select([sock], [], [], heartbeat)
+                conn.run("SELECT 1;")
+        except RuntimeError:
+            raise
+        except Exception as e:
+            logger.warning("Refresh connection lost, reconnecting in %.0f s: %s", delay, e)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(delay)
+        delay = min(delay * 2, max_retry)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the related products index.")
+    parser.add_argument('command', choices=['rebuild', 'refresh'])
+    parser.add_argument('--batch', type=int, help="buyers (rebuild) or sales (refresh) per batch")
+    parser.add_argument('--top', type=int, default=TOP_K, help="related products kept per product")
+    parser.add_argument('--follow', action='store_true', help="keep refreshing as sales arrive")
+    args = parser.parse_args()
+    if args.command == 'refresh' and args.follow:
+        follow(top_k=args.top)
+    else:
+        conn = _connect()
+        try:
+            if args.command == 'rebuild':
+                rebuild(conn, batch=args.batch or REBUILD_BATCH, top_k=args.top)
+                print("Rebuilt related products")
+            else:
+                counted = refresh(conn, batch=args.batch or REFRESH_BATCH, top_k=args.top)
+                print(f"Refreshed related products with {counted} new sales")
+        finally:
+            conn.close()
@@ -9,14 +9,23 @@ inner join products p on s."productId" = p.id
 inner join users u on s."buyerId" = u.id
 where u.id = :user_id;"""
 
-products_sql = """select
-p.id,
-p.title,
-p.description,
-p.cost,
-c.name as category
+# Queries that support field projection are written as templates with a
+# {columns} placeholder and a whitelist mapping each field to its
+# select expression; see select_columns and projected_query. Lists are
+# ordered by id in SQL, so a projection without id keeps the row order.
+products_columns = {
+    "id": "p.id",
+    "title": "p.title",
+    "description": "p.description",
+    "cost": "p.cost",
+    "category": "c.name as category",
+}
+
+products_template = """select
+{columns}
 from products p
-inner join categories c on p."categoryId" = c.id;"""
+inner join categories c on p."categoryId" = c.id
+order by p.id;"""
 
 product_by_id_sql = """select
 p.id,
@@ -28,13 +37,22 @@ from products p
 inner join categories c on p."categoryId" = c.id
 WHERE p.id = :product_id;"""
 
-user_sales_sql = """ WITH p_cat AS (SELECT 
+user_sales_columns = {
+    "user_id": "u.id as user_id",
+    "product_id": "product_id",
+    "sales_id": "s.id as sales_id",
+    "transaction_ts": "transaction_ts",
+    "product_title": "product_title",
+    "cost": "Cost",
+    "category": "p_cat.category",
+}
+
+user_sales_template = """ WITH p_cat AS (SELECT 
 p.id as product_id, p.title as product_title, p.cost as Cost, c.name as category 
 FROM products p 
 INNER JOIN categories c on p."categoryId" = c.id)
 SELECT 
-u.id as user_id, product_id, s.id as sales_id, transaction_ts,
-product_title, Cost, p_cat.category
+{columns}
 FROM sales s
 INNER JOIN p_cat ON s."productId" = p_cat.product_id
 INNER JOIN users u ON s."buyerId" = u.id
@@ -42,13 +60,12 @@ WHERE u.id = :user_id AND s.transaction_ts BETWEEN
 TO_DATE(:date_from,'YYYY-MM-DD') AND TO_DATE(:date_to,'YYYY-MM-DD');
 """
 
-user_sales_latest_sql = """ WITH p_cat AS (SELECT 
+user_sales_latest_template = """ WITH p_cat AS (SELECT 
 p.id as product_id, p.title as product_title, p.cost as Cost, c.name as category 
 FROM products p 
 INNER JOIN categories c on p."categoryId" = c.id)
 SELECT 
-u.id as user_id, product_id, s.id as sales_id, transaction_ts,
-product_title, Cost, p_cat.category
+{columns}
 FROM sales s
 INNER JOIN p_cat ON s."productId" = p_cat.product_id
 INNER JOIN users u ON s."buyerId" = u.id
@@ -56,17 +73,302 @@ WHERE u.id = :user_id
 ORDER BY transaction_ts DESC LIMIT 5;
 """
 
+# Ranked full-text search over title and description, with trigram
+# similarity on title for misspelt terms. Matches are found and ranked
+# from the stored search_vector column, so no row's text is re-parsed.
+product_search_sql = """WITH q AS (SELECT websearch_to_tsquery('english', :q) AS query)
+SELECT
+p.id,
+p.title,
+p.description,
+p.cost,
+c.name as category,
+ts_rank(p.search_vector, q.query) + similarity(p.title, :q) AS rank
+FROM products p
+INNER JOIN categories c on p."categoryId" = c.id
+CROSS JOIN q
+WHERE (p.search_vector @@ q.query OR p.title % :q)
+AND (CAST(:category AS text) IS NULL OR c.name = :category)
+AND (CAST(:min_cost AS numeric) IS NULL OR p.cost >= :min_cost)
+AND (CAST(:max_cost AS numeric) IS NULL OR p.cost <= :max_cost)
+ORDER BY rank DESC, p.id
+LIMIT :limit OFFSET :offset;"""
+
+all_users_columns = {
+    "first_name": "u.first_name",
+    "last_name": "u.last_name",
+    "id": "u.id",
+}
 
-all_users_sql = "SELECT u.first_name, u.last_name, u.id from users u;"
+all_users_template = "SELECT {columns} from users u ORDER BY u.id;"
 user_by_id_sql = "SELECT u.first_name, u.last_name, u.id FROM users u WHERE u.id = :user_id;"
 
+related_products_sql = """SELECT
+r."relatedId" as id,
+p.title,
+p.cost,
+c.name as category,
+r.buyers
+FROM related_products r
+INNER JOIN products p on r."relatedId" = p.id
+INNER JOIN categories c on p."categoryId" = c.id
+WHERE r."productId" = :product_id
+ORDER BY r.rank
+LIMIT :limit;"""
+
+projections = {
+    "products": (products_template, products_columns),
+    "all_users": (all_users_template, all_users_columns),
+    "user_sales": (user_sales_template, user_sales_columns),
+    "user_sales_latest": (user_sales_latest_template, user_sales_columns),
+}
+
+# Projections generated so far, by (key, fields) and by SQL for logging
+projected_queries = {}
+projected_keys = {}
+
+
+def select_columns(key, fields=None):
+    """Returns the requested fields of a query in select order.
+
+    Args:
+        key (string): key of the query in projections.
+        fields (list): field names, default all fields.
+
+    Raises:
+        ValueError if a field is not in the query's whitelist.
+    """
+    columns = projections[key][1]
+    if not fields:
+        return list(columns)
+    unknown = set(fields) - set(columns)
+    if unknown:
+        raise ValueError(f"Unknown fields for {key}: {', '.join(sorted(unknown))}")
+    return [name for name in columns if name in fields]
+
+
+def projected_query(key, fields=None):
+    """Returns a query selecting only the requested fields.
+
+    Joins and filters are unchanged, only the select list narrows.
+
+    Args:
+        key (string): key of the query in projections.
+        fields (list): field names, default all fields.
+
+    Raises:
+        ValueError if a field is not in the query's whitelist.
+    """
+    names = tuple(select_columns(key, fields))
+    query = projected_queries.get((key, names))
+    if query is None:
+        template, columns = projections[key]
+        query = template.replace('{columns}', ', '.join(columns[name] for name in names))
+        projected_queries[(key, names)] = query
+        if len(names) < len(columns):
+            projected_keys[query] = f"{key}[{','.join(names)}]"
+    return query
+
+
 query_strings = {
     "categories": "SELECT * from categories;",
-    "products": products_sql,
+    "products": projected_query("products"),
     "product_by_id": product_by_id_sql,
     "sales_average": sales_average_sql,
-    "all_users": all_users_sql,
+    "all_users": projected_query("all_users"),
     "user_by_id": user_by_id_sql,
-    "user_sales": user_sales_sql,
-    "user_sales_latest": user_sales_latest_sql,
+    "user_sales": projected_query("user_sales"),
+    "user_sales_latest": projected_query("user_sales_latest"),
+    "product_search": product_search_sql,
+    "related_products": related_products_sql,
+    "listen_user_sales": "LISTEN user_sales;",
+    "user_sales_triggers": "SELECT tgrelid::regclass::text AS table_name FROM pg_trigger WHERE tgname = 'notify_user_sales';",
+}
+
+# Adding the generated column rewrites products once, under an exclusive
+# lock; the indexes are then built without blocking writes.
+product_search_indexes_sql = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    """ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (to_tsvector('english', title || ' ' || coalesce(description, ''))) STORED;""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS products_search_vector_idx ON products
+USING GIN (search_vector);""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS products_title_trgm_idx ON products
+USING GIN (title gin_trgm_ops);""",
+]
+
+# Co-purchase index: product_pairs counts the distinct buyers of every
+# pair of products, related_products keeps the top pairs per product
+# for serving, and related_products_state records that it was built.
+# Every inserted sale is queued in related_pending_sales by a trigger
+# in the inserting transaction, so a sale becomes visible to refresh
+# exactly when it commits, whatever the order of the sale ids.
+related_products_tables_sql = """CREATE TABLE IF NOT EXISTS product_pairs (
+    "productId" integer NOT NULL,
+    "relatedId" integer NOT NULL,
+    buyers integer NOT NULL,
+    PRIMARY KEY ("productId", "relatedId")
+);
+
+CREATE TABLE IF NOT EXISTS related_products (
+    "productId" integer NOT NULL,
+    rank integer NOT NULL,
+    "relatedId" integer NOT NULL,
+    buyers integer NOT NULL,
+    PRIMARY KEY ("productId", rank)
+);
+
+CREATE TABLE IF NOT EXISTS related_products_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    built_at timestamptz NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS related_pending_sales (
+    sale_id integer PRIMARY KEY
+);
+
+CREATE OR REPLACE FUNCTION queue_related_sale() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO related_pending_sales (sale_id) VALUES (NEW.id) ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS queue_related_sale ON sales;
+CREATE TRIGGER queue_related_sale AFTER INSERT ON sales
+FOR EACH ROW EXECUTE FUNCTION queue_related_sale();
+"""
+
+sales_buyer_product_index_sql = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS sales_buyer_product_idx
+ON sales ("buyerId", "productId", id);""",
+]
+
+# Notifies channel user_sales with the id of every user whose cached
+# sales or details change, or '*' when products or categories change.
+user_sales_notify_sql = """CREATE OR REPLACE FUNCTION notify_user_sales() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME IN ('products', 'categories') THEN
+        PERFORM pg_notify('user_sales', '*');
+    ELSIF TG_TABLE_NAME = 'sales' THEN
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('user_sales', NEW."buyerId"::text);
+        END IF;
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('user_sales', OLD."buyerId"::text);
+        END IF;
+    ELSE
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('user_sales', NEW.id::text);
+        END IF;
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('user_sales', OLD.id::text);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notify_user_sales ON sales;
+CREATE TRIGGER notify_user_sales AFTER INSERT OR UPDATE OR DELETE ON sales
+FOR EACH ROW EXECUTE FUNCTION notify_user_sales();
+
+DROP TRIGGER IF EXISTS notify_user_sales ON users;
+CREATE TRIGGER notify_user_sales AFTER INSERT OR UPDATE OR DELETE ON users
+FOR EACH ROW EXECUTE FUNCTION notify_user_sales();
+
+DROP TRIGGER IF EXISTS notify_user_sales ON products;
+CREATE TRIGGER notify_user_sales AFTER UPDATE OR DELETE ON products
+FOR EACH ROW EXECUTE FUNCTION notify_user_sales();
+
+DROP TRIGGER IF EXISTS notify_user_sales ON categories;
+CREATE TRIGGER notify_user_sales AFTER UPDATE OR DELETE ON categories
+FOR EACH ROW EXECUTE FUNCTION notify_user_sales();
+"""
+
+# A migration is a script run as one implicit transaction, or a list of
+# statements run one at a time, as CREATE INDEX CONCURRENTLY must be.
+migrations = {
+    "product_search_indexes": product_search_indexes_sql,
+    "related_products_tables": related_products_tables_sql,
+    "sales_buyer_product_index": sales_buyer_product_index_sql,
+    "user_sales_notify": user_sales_notify_sql,
+}
+
+# Statements run by data/related.py to build the co-purchase index.
+# Every buyer counts once per pair of products they have bought. Sales
+# still queued in related_pending_sales are not counted yet.
+related_index_sql = {
+    "lock": "SELECT pg_advisory_lock(hashtext('related_products'));",
+    "unlock": "SELECT pg_advisory_unlock(hashtext('related_products'));",
+    "begin": "START TRANSACTION;",
+    "commit": "COMMIT;",
+    "rollback": "ROLLBACK;",
+    "built": "SELECT built_at FROM related_products_state;",
+    "clear_built": "DELETE FROM related_products_state;",
+    "set_built": """INSERT INTO related_products_state (id, built_at)
+VALUES (true, now())
+ON CONFLICT (id) DO UPDATE SET built_at = EXCLUDED.built_at;""",
+    "buyer_range": 'SELECT min("buyerId"), max("buyerId") FROM sales;',
+    "clear_pairs": "TRUNCATE product_pairs;",
+    "count_buyer_batch": """WITH bought AS (
+SELECT DISTINCT "buyerId", "productId" FROM sales s
+WHERE "buyerId" >= :buyer_from AND "buyerId" < :buyer_to
+AND NOT EXISTS (SELECT 1 FROM related_pending_sales q WHERE q.sale_id = s.id))
+INSERT INTO product_pairs ("productId", "relatedId", buyers)
+SELECT a."productId", b."productId", count(*)
+FROM bought a
+INNER JOIN bought b ON a."buyerId" = b."buyerId" AND a."productId" <> b."productId"
+GROUP BY a."productId", b."productId"
+ON CONFLICT ("productId", "relatedId")
+DO UPDATE SET buyers = product_pairs.buyers + EXCLUDED.buyers;""",
+    "drain_pending": """DELETE FROM related_pending_sales WHERE sale_id IN (
+SELECT sale_id FROM related_pending_sales ORDER BY sale_id LIMIT :batch)
+RETURNING sale_id;""",
+    # For the buyers of the drained sales, a pair is new if the buyer
+    # had not bought both products among the sales counted before, i.e.
+    # those neither drained nor still queued. Each buyer adds one to
+    # each new pair, in both directions.
+    "count_new_sales": """WITH counted AS (
+SELECT DISTINCT "buyerId", "productId" FROM sales s
+WHERE "buyerId" IN (SELECT "buyerId" FROM sales WHERE id = ANY(:sale_ids))
+AND NOT s.id = ANY(:sale_ids)
+AND NOT EXISTS (SELECT 1 FROM related_pending_sales q WHERE q.sale_id = s.id)),
+added AS (
+SELECT DISTINCT "buyerId", "productId" FROM sales s
+WHERE id = ANY(:sale_ids)
+AND NOT EXISTS (SELECT 1 FROM counted c
+    WHERE c."buyerId" = s."buyerId" AND c."productId" = s."productId")),
+bought AS (
+SELECT "buyerId", "productId", false AS added FROM counted
+UNION ALL
+SELECT "buyerId", "productId", true FROM added),
+pairs AS (
+SELECT n."productId" AS a, o."productId" AS b, o.added AS both_added
+FROM bought n
+INNER JOIN bought o ON o."buyerId" = n."buyerId" AND o."productId" <> n."productId"
+WHERE n.added),
+counts AS (
+SELECT a, b, count(*) AS buyers
+FROM (SELECT a, b FROM pairs UNION ALL SELECT b, a FROM pairs WHERE NOT both_added) both_ways
+GROUP BY a, b)
+INSERT INTO product_pairs ("productId", "relatedId", buyers)
+SELECT a, b, buyers FROM counts
+ON CONFLICT ("productId", "relatedId")
+DO UPDATE SET buyers = product_pairs.buyers + EXCLUDED.buyers
+RETURNING "productId";""",
+    "clear_top": "DELETE FROM related_products;",
+    "clear_top_for": 'DELETE FROM related_products WHERE "productId" = ANY(:product_ids);',
+    "rank_top": """INSERT INTO related_products ("productId", rank, "relatedId", buyers)
+SELECT "productId", rank, "relatedId", buyers FROM (
+SELECT "productId", "relatedId", buyers,
+row_number() OVER (PARTITION BY "productId" ORDER BY buyers DESC, "relatedId") AS rank
+FROM product_pairs) ranked
+WHERE rank <= :top_k;""",
+    "rank_top_for": """INSERT INTO related_products ("productId", rank, "relatedId", buyers)
+SELECT "productId", rank, "relatedId", buyers FROM (
+SELECT "productId", "relatedId", buyers,
+row_number() OVER (PARTITION BY "productId" ORDER BY buyers DESC, "relatedId") AS rank
+FROM product_pairs WHERE "productId" = ANY(:product_ids)) ranked
+WHERE rank <= :top_k;""",
 }
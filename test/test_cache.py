@@ -0,0 +1,143 @@
+import pytest
+import socket
+from collections import deque
+from types import SimpleNamespace
+from src.api.cache import UserCache, SalesListener, _buffered, TRIGGER_TABLES
+from src.api.routes import process_user_query
+from src.data.sql import query_strings
+from unittest.mock import patch, MagicMock
+from flask import Flask, jsonify
+from data import users_result, multiple_sales
+
+
+@pytest.fixture
+def app_context():
+    app = Flask(__name__)
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def cache():
+    cache = UserCache()
+    cache.enabled = True
+    return cache
+
+
+def test_user_cache_stores_and_returns_result(cache):
+    cache.set(2, 'user_sales_latest', multiple_sales, cache.version(2))
+    assert cache.get(2, 'user_sales_latest') == multiple_sales
+    assert cache.get(3, 'user_sales_latest') is None
+
+
+def test_user_cache_bypassed_when_disabled(cache):
+    cache.set(2, 'user_by_id', users_result, cache.version(2))
+    cache.enabled = False
+    assert cache.get(2, 'user_by_id') is None
+
+
+def test_user_cache_invalidate_drops_only_user(cache):
+    cache.set(1, 'user_by_id', [users_result[0]], cache.version(1))
+    cache.set(2, 'user_by_id', [users_result[1]], cache.version(2))
+    cache.invalidate(2)
+    assert cache.get(1, 'user_by_id') == [users_result[0]]
+    assert cache.get(2, 'user_by_id') is None
+
+
+def test_user_cache_ignores_result_invalidated_during_query(cache):
+    version = cache.version(2)
+    cache.invalidate(2)
+    cache.set(2, 'user_by_id', [users_result[1]], version)
+    assert cache.get(2, 'user_by_id') is None
+    version = cache.version(2)
+    cache.clear()
+    cache.set(2, 'user_by_id', [users_result[1]], version)
+    assert cache.get(2, 'user_by_id') is None
+
+
+def test_user_cache_evicts_least_recently_used_user():
+    cache = UserCache(max_users=2)
+    cache.enabled = True
+    for user_id in (1, 2):
+        cache.set(user_id, 'user_by_id', [], cache.version(user_id))
+    cache.get(1, 'user_by_id')
+    cache.set(3, 'user_by_id', [], cache.version(3))
+    assert cache.get(1, 'user_by_id') == []
+    assert cache.get(2, 'user_by_id') is None
+    assert cache.get(3, 'user_by_id') == []
+    assert list(cache._entries) == [1, 3]
+
+
+def test_user_cache_bounds_invalidations_without_losing_them():
+    cache = UserCache(max_users=2)
+    cache.enabled = True
+    version = cache.version(1)
+    for user_id in (1, 2, 3):
+        cache.invalidate(user_id)
+    assert list(cache._invalidated) == [2, 3]
+    cache.set(1, 'user_by_id', [], version)
+    assert cache.get(1, 'user_by_id') is None
+    cache.set(1, 'user_by_id', [], cache.version(1))
+    assert cache.get(1, 'user_by_id') == []
+
+
+def test_buffered_detects_data_select_would_miss():
+    listener_sock, server_sock = socket.socketpair()
+    with listener_sock, server_sock:
+        listener_sock.settimeout(3.0)
+        conn = SimpleNamespace(_usock=listener_sock, _sock=listener_sock.makefile('rwb'))
+        assert not _buffered(conn)
+        server_sock.sendall(b'ZA')
+        assert conn._sock.read(1) == b'Z'
+        assert _buffered(conn)
+        assert listener_sock.gettimeout() == 3.0
+
+
+def test_listener_applies_notifications(cache):
+    for user_id in (1, 2, 3):
+        cache.set(user_id, 'user_by_id', [], cache.version(user_id))
+    notifications = deque([(1, 'user_sales', '1'), (1, 'user_sales', '3')], maxlen=100)
+    SalesListener(cache).apply(notifications)
+    assert cache.get(1, 'user_by_id') is None
+    assert cache.get(2, 'user_by_id') == []
+    assert cache.get(3, 'user_by_id') is None
+    assert len(notifications) == 0
+    SalesListener(cache).apply(deque([(1, 'user_sales', '*')]))
+    assert cache.get(2, 'user_by_id') is None
+
+
+def test_listener_clears_cache_on_full_notification_queue(cache):
+    cache.set(2, 'user_by_id', [], cache.version(2))
+    notifications = deque([(1, 'user_sales', '1')] * 3, maxlen=3)
+    SalesListener(cache).apply(notifications)
+    assert cache.get(2, 'user_by_id') is None
+
+
+def test_process_user_query_serves_repeat_from_cache(app_context, cache):
+    with patch('src.api.routes.user_cache', cache):
+        with patch('src.api.routes.process_query',
+                   return_value=jsonify(multiple_sales)) as mock_process:
+            first = process_user_query(2, 'user_sales_latest')
+            second = process_user_query(2, 'user_sales_latest')
+            mock_process.assert_called_once_with(query_strings['user_sales_latest'], user_id=2)
+            assert first.json == second.json == multiple_sales
+
+
+def test_listener_disables_cache_when_heartbeat_times_out(cache):
+    listener = SalesListener(cache, heartbeat=0.01, retry=0)
+    conn = MagicMock(_usock=None, notifications=deque())
+
+    def run(query, **params):
+        if query == query_strings['user_sales_triggers']:
+            return [[table] for table in TRIGGER_TABLES]
+        if query == "SELECT 1;":
+            listener.stop()
+            raise socket.timeout("timed out")
+        return []
+
+    conn.run.side_effect = run
+    with patch('src.api.routes.get_db_connection', return_value=conn) as mock_connect:
+        listener.run()
+    mock_connect.assert_called_once_with(timeout=0.01)
+    assert not cache.enabled
+    conn.close.assert_called_once()
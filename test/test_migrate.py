@@ -0,0 +1,14 @@
+from src.data.migrate import apply_migrations
+from unittest.mock import patch, call
+
+
+def test_apply_migrations_runs_statement_lists_one_at_a_time():
+    migrations = {"script": "CREATE TABLE a (id int);", "steps": ["SELECT 1;", "SELECT 2;"]}
+    with patch('src.data.migrate.migrations', migrations):
+        with patch('src.api.routes.get_db_connection') as mock_connect:
+            apply_migrations(["steps", "script"])
+    conn = mock_connect.return_value
+    assert conn.run.call_args_list == [
+        call("SELECT 1;"), call("SELECT 2;"), call("CREATE TABLE a (id int);")
+    ]
+    conn.close.assert_called_once()
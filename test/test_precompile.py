@@ -0,0 +1,90 @@
+import json
+import pytest
+from src.api.precompile import build_spec, load_precompiled, lazy_handler,\
+    LazyResolver
+from unittest.mock import patch
+import inspect
+
+sample_spec = """openapi: 3.0.0
+info:
+  title: "Test API"
+  version: "1.0.0"
+paths:
+  /things/{thing_id}:
+    get:
+      operationId: "test_precompile.sample_handler"
+      parameters:
+        - in: path
+          name: thing_id
+          required: true
+          schema:
+            type: integer
+      responses:
+        "200":
+          description: "Thing"
+"""
+
+
+def sample_handler(thing_id, verbose=False):
+    return {"thing_id": thing_id, "verbose": verbose}
+
+
+@pytest.fixture
+def spec_dir(tmp_path):
+    (tmp_path / 'swagger.yml').write_text(sample_spec)
+    return str(tmp_path)
+
+
+def test_build_spec_writes_spec_and_handler_arguments(spec_dir):
+    build_spec(spec_dir)
+    with open(f"{spec_dir}/swagger.json") as artifact:
+        precompiled = json.load(artifact)
+    assert precompiled['spec']['info']['title'] == "Test API"
+    assert precompiled['handlers'] == {
+        "test_precompile.sample_handler": ["thing_id", "verbose"]
+    }
+
+
+def test_load_precompiled_returns_none_if_missing(spec_dir):
+    assert load_precompiled(spec_dir) is None
+
+
+def test_load_precompiled_returns_artifact(spec_dir):
+    expected = build_spec(spec_dir)
+    assert load_precompiled(spec_dir) == expected
+
+
+def test_load_precompiled_returns_none_if_stale(spec_dir):
+    build_spec(spec_dir)
+    with open(f"{spec_dir}/swagger.yml", 'a') as source:
+        source.write("# changed\n")
+    assert load_precompiled(spec_dir) is None
+
+
+def test_load_precompiled_returns_none_if_handler_module_changed(tmp_path, monkeypatch):
+    (tmp_path / 'swagger.yml').write_text(
+        sample_spec.replace("test_precompile.sample_handler", "lazy_things.get_thing"))
+    handlers = tmp_path / 'lazy_things.py'
+    handlers.write_text("def get_thing(thing_id):\n    return thing_id\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    build_spec(str(tmp_path))
+    assert load_precompiled(str(tmp_path)) is not None
+    handlers.write_text("def get_thing(thing_id, verbose=False):\n    return thing_id\n")
+    assert load_precompiled(str(tmp_path)) is None
+
+
+def test_lazy_handler_imports_on_first_call():
+    with patch('src.api.precompile.get_function_from_name',
+               return_value=sample_handler) as mock_import:
+        handler = lazy_handler("test_precompile.sample_handler", ["thing_id", "verbose"])
+        mock_import.assert_not_called()
+        assert list(inspect.signature(handler).parameters) == ["thing_id", "verbose"]
+        assert handler(thing_id=3) == {"thing_id": 3, "verbose": False}
+        assert handler(thing_id=4, verbose=True) == {"thing_id": 4, "verbose": True}
+        mock_import.assert_called_once_with("test_precompile.sample_handler")
+
+
+def test_lazy_resolver_falls_back_for_unknown_operation_id():
+    resolver = LazyResolver({})
+    handler = resolver.resolve_function_from_operation_id("test_precompile.sample_handler")
+    assert handler is sample_handler
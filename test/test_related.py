@@ -0,0 +1,145 @@
+import pytest
+from collections import deque
+from src.data.related import rebuild, refresh, follow
+from src.data.sql import related_index_sql as sql, migrations
+from unittest.mock import MagicMock, patch
+
+
+def make_conn(results):
+    conn = MagicMock()
+    conn.run.side_effect = lambda query, **params: results.get(query, [])
+    return conn
+
+
+def statements(conn):
+    return [(c.args[0], c.kwargs) for c in conn.run.call_args_list]
+
+
+def test_rebuild_counts_buyers_in_batches_then_swaps_top_products():
+    conn = make_conn({sql['buyer_range']: [[1, 25]]})
+    rebuild(conn, batch=10, top_k=5)
+    run = statements(conn)
+    batches = [params for query, params in run if query == sql['count_buyer_batch']]
+    assert batches == [
+        {"buyer_from": 1, "buyer_to": 11},
+        {"buyer_from": 11, "buyer_to": 21},
+        {"buyer_from": 21, "buyer_to": 31},
+    ]
+    queries = [query for query, _ in run]
+    assert queries.index(sql['clear_built']) < queries.index(sql['count_buyer_batch'])
+    assert queries[-6:] == [sql['begin'], sql['clear_top'], sql['rank_top'],
+                            sql['set_built'], sql['commit'], sql['unlock']]
+
+
+def test_rebuild_leaves_queued_sales_to_refresh():
+    assert 'related_pending_sales' in sql['count_buyer_batch']
+    assert 'CREATE TRIGGER queue_related_sale AFTER INSERT ON sales' in \
+        migrations['related_products_tables']
+
+
+def test_refresh_requires_rebuild():
+    conn = make_conn({sql['built']: []})
+    with pytest.raises(RuntimeError):
+        refresh(conn)
+    assert statements(conn)[-1][0] == sql['unlock']
+
+
+def queued_conn(queue, touched):
+    """Returns a connection whose pending sales queue is the queue list."""
+    def run(query, **params):
+        if query == sql['built']:
+            return [["2026-10-18"]]
+        if query == sql['drain_pending']:
+            drained = sorted(queue)[:params['batch']]
+            del queue[:len(drained)]
+            return [[sale_id] for sale_id in drained]
+        if query == sql['count_new_sales']:
+            return [[product_id] for product_id in touched]
+        return []
+
+    conn = MagicMock()
+    conn.run.side_effect = run
+    return conn
+
+
+def test_refresh_ranks_touched_products_per_batch():
+    conn = queued_conn([101, 102, 103], touched=[7, 3, 7])
+    assert refresh(conn, batch=2, top_k=5) == 3
+    run = statements(conn)
+    assert [params for query, params in run if query == sql['count_new_sales']] == \
+        [{"sale_ids": [101, 102]}, {"sale_ids": [103]}]
+    assert (sql['rank_top_for'], {"product_ids": [3, 7], "top_k": 5}) in run
+    assert [query for query, _ in run].count(sql['commit']) == 2
+
+
+def test_refresh_counts_sale_committed_after_higher_ids():
+    queue = [101, 102, 104]
+    conn = queued_conn(queue, touched=[3])
+    assert refresh(conn) == 3
+    queue.append(103)
+    assert refresh(conn) == 1
+    counted = [params['sale_ids'] for query, params in statements(conn)
+               if query == sql['count_new_sales']]
+    assert counted == [[101, 102, 104], [103]]
+
+
+def test_refresh_rolls_back_failed_batch():
+    def run(query, **params):
+        if query == sql['built']:
+            return [["2026-10-18"]]
+        if query == sql['drain_pending']:
+            return [[101]]
+        if query == sql['count_new_sales']:
+            raise RuntimeError("connection lost")
+        return []
+
+    conn = MagicMock()
+    conn.run.side_effect = run
+    with pytest.raises(RuntimeError):
+        refresh(conn)
+    queries = [query for query, _ in statements(conn)]
+    assert queries[-2:] == [sql['rollback'], sql['unlock']]
+    assert sql['commit'] not in queries
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_follow_reconnects_with_backoff():
+    results = {sql['built']: [["2026-10-18"]]}
+
+    def run(query, **params):
+        if query == "SELECT 1;":
+            raise ConnectionError("connection reset")
+        return results.get(query, [])
+
+    conn = MagicMock(_usock=None, notifications=deque())
+    conn.run.side_effect = run
+    connect = MagicMock(side_effect=[OSError("refused"), OSError("refused"), conn, Stop()])
+    with patch('src.data.related.time.sleep') as mock_sleep:
+        with pytest.raises(Stop):
+            follow(connect, heartbeat=60, retry=1, max_retry=3)
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2, 60, 1]
+    conn.close.assert_called_once()
+
+
+def test_sales_index_is_built_concurrently():
+    assert migrations['sales_buyer_product_index'][0].startswith(
+        'CREATE INDEX CONCURRENTLY')
+    assert 'CREATE INDEX' not in migrations['related_products_tables']
+
+
+def test_follow_skips_select_when_notification_is_buffered():
+    def run(query, **params):
+        if query == "SELECT 1;":
+            raise Stop()
+        return [["2026-10-18"]] if query == sql['built'] else []
+
+    conn = MagicMock(notifications=deque())
+    conn.run.side_effect = run
+    with patch('src.data.related._buffered', return_value=True), \
+            patch('src.data.related.select.select') as mock_select:
+        with pytest.raises(Stop):
+            follow(lambda: conn)
+    mock_select.assert_not_called()
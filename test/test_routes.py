@@ -2,7 +2,7 @@ import pytest
 from src.api.routes import get_products, get_categories,  get_product,\
     get_user_average_spend, process_query, get_db_connection, \
     get_users, get_user_by_id, get_user_sales, get_user_sales_latest, \
-    get_products_for_category,\
+    get_products_for_category, search_products, get_related_products,\
     DBConnectionException
 from unittest.mock import patch
 from flask import Flask, jsonify
@@ -67,10 +67,20 @@ def test_get_db_creates_connection(mock_conn, mock_env, app_context):
         user='def',
         port='5432',
         password='password',
-        database='db'
+        database='db',
+        timeout=None
     )
 
 
+@patch('src.api.routes.Connection', autospec=True)
+def test_get_db_applies_timeout(mock_conn, mock_env, app_context):
+    with patch.dict('os.environ', {'DB_TIMEOUT': '5'}):
+        get_db_connection()
+    assert mock_conn.call_args.kwargs['timeout'] == 5.0
+    get_db_connection(timeout=2)
+    assert mock_conn.call_args.kwargs['timeout'] == 2
+
+
 def test_get_db_raises_error_on_incorrect_connection(mock_env, app_context):
     with pytest.raises(DBConnectionException):
         get_db_connection()
@@ -90,6 +100,13 @@ def test_process_query_returns_sorted_dict_array(app_context):
         result = process_query('test query unsorted')
         assert result.json == sample_result
 
+def test_process_query_keeps_query_order_if_not_sorting(app_context):
+    with patch('src.api.routes.get_db_connection') as mock_conn:
+        mock_conn().run.side_effect = db_data
+        mock_conn().columns = sample_headers
+        result = process_query('test query unsorted', sort_by_id=False)
+        assert result.json == sample_result[::-1]
+
 def test_process_query_works_with_parameters(mock_env, app_context):
     with patch('src.api.routes.Connection', autospec=True) as mock_conn:
         mock_conn().columns = sample_headers
@@ -257,3 +274,46 @@ def test_get_products_for_category_sorts_correctly(app_context):
     with patch('src.api.routes.process_query',
                side_effect=dummy_process):
         assert get_products_for_category("Movies",sort='id') == [products_expected[2],products_expected[0]]
+
+def test_search_products_passes_filters_and_keeps_rank_order(app_context):
+    patch_return = jsonify(products_expected)
+    with patch('src.api.routes.process_query',
+               return_value=patch_return) as mock_process:
+        expected_query = query_strings['product_search']
+        result = search_products('car', category='Movies', min_cost=5, limit=10)
+        mock_process.assert_called_with(expected_query, sort_by_id=False, q='car',
+                                        category='Movies', min_cost=5, max_cost=None,
+                                        limit=10, offset=0)
+        assert result.json == products_expected
+
+def test_get_products_selects_only_requested_fields(app_context):
+    with patch('src.api.routes.process_query',
+               return_value=jsonify([{"id": 5, "title": "Car"}])) as mock_process:
+        result = get_products(fields=['title', 'id'])
+        query = mock_process.call_args[0][0]
+        assert query.startswith('select\np.id, p.title\nfrom products p')
+        assert result.json == [{"id": 5, "title": "Car"}]
+
+def test_get_user_sales_latest_selects_only_requested_fields(app_context):
+    with patch('src.api.routes.process_query',
+               return_value=jsonify(multiple_sales)) as mock_process:
+        get_user_sales_latest(2, fields=['sales_id', 'cost'])
+        query = mock_process.call_args[0][0]
+        assert 'SELECT \ns.id as sales_id, Cost\nFROM sales s' in query
+        assert query.endswith('ORDER BY transaction_ts DESC LIMIT 5;\n')
+
+def test_get_related_products_keeps_rank_order(app_context):
+    related = [products_expected[2], products_expected[0]]
+    with patch('src.api.routes.process_query',
+               return_value=jsonify(related)) as mock_process:
+        result = get_related_products(5, limit=2)
+        mock_process.assert_called_with(query_strings['related_products'],
+                                        sort_by_id=False, product_id=5, limit=2)
+        assert result.json == related
+
+def test_get_related_products_returns_error_message_for_wrong_id(app_context):
+    with patch('src.api.routes.process_query',
+               return_value=jsonify([])):
+        expected = {"id": 77, "query_error": "Product does not exist"}
+        result = get_related_products(77)
+        assert result.json == expected
@@ -0,0 +1,83 @@
+import glob
+import os
+import pytest
+import signal
+from src.api.serve import reload, stop, read_pid, write_ready_marker,\
+    remove_ready_markers
+from unittest.mock import patch, call
+
+
+@pytest.fixture
+def pidfile(tmp_path):
+    path = tmp_path / 'api.pid'
+    path.write_text("100\n")
+    return str(path)
+
+
+def test_read_pid_returns_none_if_missing(tmp_path):
+    assert read_pid(str(tmp_path / 'missing.pid')) is None
+
+
+def test_reload_stops_old_master_once_new_workers_are_ready(pidfile):
+    def start_new_master(pid, sig):
+        if sig == signal.SIGUSR2:
+            with open(pidfile + '.2', 'w') as new_pidfile:
+                new_pidfile.write("200\n")
+
+    sleeps = []
+
+    def warm_new_worker(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) < 4:
+            write_ready_marker(200 if len(sleeps) > 1 else 100, 200 + len(sleeps),
+                               {"/api/categories": 200}, pidfile)
+
+    with patch('src.api.serve.os.kill', side_effect=start_new_master) as mock_kill, \
+            patch('src.api.serve.time.sleep', side_effect=warm_new_worker):
+        assert reload(workers=2, pidfile=pidfile) == 200
+        assert mock_kill.call_args_list == [call(100, signal.SIGUSR2), call(100, signal.SIGTERM)]
+    assert len(sleeps) == 3
+
+
+def test_reload_keeps_old_master_if_new_one_fails(pidfile):
+    with patch('src.api.serve.os.kill') as mock_kill:
+        with pytest.raises(RuntimeError):
+            reload(workers=1, timeout=0.3, pidfile=pidfile)
+        mock_kill.assert_called_once_with(100, signal.SIGUSR2)
+
+
+def test_reload_stops_new_master_if_workers_do_not_warm_up(pidfile):
+    with open(pidfile + '.2', 'w') as new_pidfile:
+        new_pidfile.write("200\n")
+    with patch('src.api.serve.os.kill') as mock_kill:
+        with pytest.raises(RuntimeError):
+            reload(workers=1, timeout=0.3, pidfile=pidfile)
+        assert mock_kill.call_args_list == [call(100, signal.SIGUSR2), call(200, signal.SIGTERM)]
+
+
+def test_reload_keeps_old_master_if_a_warm_up_failed(pidfile):
+    with open(pidfile + '.2', 'w') as new_pidfile:
+        new_pidfile.write("200\n")
+    write_ready_marker(200, 201, {"/api/categories": 200}, pidfile)
+    write_ready_marker(200, 202, {"/api/categories": 500, "/api/products?fields=id": "timed out"},
+                       pidfile)
+    with patch('src.api.serve.os.kill') as mock_kill:
+        with pytest.raises(RuntimeError, match="/api/categories: 500"):
+            reload(workers=2, timeout=5, pidfile=pidfile)
+        assert mock_kill.call_args_list == [call(100, signal.SIGUSR2), call(200, signal.SIGTERM)]
+
+
+def test_remove_ready_markers_of_one_or_all_workers(pidfile):
+    for worker_pid in (201, 202):
+        write_ready_marker(200, worker_pid, {}, pidfile)
+    write_ready_marker(100, 101, {}, pidfile)
+    remove_ready_markers(200, 201, pidfile)
+    assert [os.path.basename(p) for p in sorted(glob.glob(pidfile + '.*.ready'))] == \
+        ['api.pid.100.101.ready', 'api.pid.200.202.ready']
+    remove_ready_markers(200, pidfile=pidfile)
+    assert glob.glob(pidfile + '.200.*') == []
+
+
+def test_stop_raises_if_no_server(tmp_path):
+    with pytest.raises(RuntimeError):
+        stop(str(tmp_path / 'missing.pid'))
@@ -0,0 +1,148 @@
+import pytest
+from src.api.slowlog import SlowQueryLog, query_key, redact, read_entries,\
+    summarise, scrub_plan, slow_query_log, ROOT_DIR
+from src.data.sql import query_strings
+from unittest.mock import MagicMock, patch, call
+import os
+import threading
+from flask import Flask
+
+
+@pytest.fixture
+def app_context():
+    app = Flask(__name__)
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def slow_log(tmp_path):
+    return SlowQueryLog(str(tmp_path / 'slow.jsonl'), threshold_ms=100, sample_rate=0)
+
+
+def test_query_key_finds_query_strings_key():
+    assert query_key(query_strings['user_sales_latest']) == 'user_sales_latest'
+    assert query_key(' select 1;\nfrom x') == 'select 1;'
+
+
+def test_redact_keeps_only_types():
+    assert redact({"user_id": 3, "date_from": "2022-11-11"}) == \
+        {"user_id": "int", "date_from": "str"}
+
+
+def test_observe_ignores_fast_queries(slow_log):
+    slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.05, None)
+    assert read_entries(slow_log.path) == []
+
+
+def test_observe_writes_redacted_entry(slow_log):
+    slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25, None)
+    entries = read_entries(slow_log.path)
+    assert len(entries) == 1
+    assert entries[0]['query'] == 'user_by_id'
+    assert entries[0]['params'] == {"user_id": "int"}
+    assert entries[0]['rows'] == 1
+    assert entries[0]['duration_ms'] == 250.0
+
+
+def test_observe_captures_sampled_plan_on_new_connection(slow_log):
+    slow_log.sample_rate = 1
+    conn = MagicMock()
+    conn.run.return_value = [["Index Scan on users u"], ["  Index Cond: (id = 3)"]]
+    thread = slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25,
+                              lambda: conn)
+    thread.join()
+    assert conn.run.call_args_list == [
+        call("START TRANSACTION READ ONLY;"),
+        call('EXPLAIN (ANALYZE, BUFFERS) ' + query_strings['user_by_id'], user_id=3),
+        call("ROLLBACK;"),
+    ]
+    conn.close.assert_called_once()
+    entries = read_entries(slow_log.path)
+    assert entries[0]['plan'] == "Index Scan on users u\n  Index Cond: (id = ?)"
+
+
+def test_observe_limits_plans_in_flight_and_per_key(slow_log):
+    slow_log.sample_rate = 1
+    started, release = threading.Event(), threading.Event()
+
+    def connect():
+        started.set()
+        release.wait(5)
+        return MagicMock()
+
+    first = slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25, connect)
+    started.wait(5)
+    assert slow_log.observe(query_strings['products'], {}, 90, 0.25, connect) is None
+    release.set()
+    first.join()
+    assert slow_log.observe(query_strings['user_by_id'], {"user_id": 4}, 1, 0.25, connect) is None
+    slow_log.observe(query_strings['products'], {}, 90, 0.25, connect).join()
+    assert len(read_entries(slow_log.path)) == 4
+
+
+def test_observe_only_warns_if_log_cannot_be_written(tmp_path):
+    slow_log = SlowQueryLog(str(tmp_path / 'missing' / 'slow.jsonl'), threshold_ms=100,
+                            sample_rate=0)
+    assert slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25, None) is None
+
+
+def test_default_log_is_in_root_directory():
+    if 'SLOW_QUERY_LOG' not in os.environ:
+        assert slow_query_log.path == os.path.join(ROOT_DIR, 'slow_queries.jsonl')
+    assert os.path.exists(os.path.join(ROOT_DIR, 'requirements.txt'))
+
+
+def test_scrub_plan_replaces_condition_literals_only():
+    plan = "\n".join([
+        "Seq Scan on products p  (cost=0.00..1.50 rows=2 width=8)",
+        "  Filter: ((title = 'O''Brien'::text) AND (cost >= 5.5) AND (id = $1))",
+        "  Rows Removed by Filter: 12",
+    ])
+    assert scrub_plan(plan).splitlines() == [
+        "Seq Scan on products p  (cost=0.00..1.50 rows=2 width=8)",
+        "  Filter: ((title = '?'::text) AND (cost >= ?) AND (id = $1))",
+        "  Rows Removed by Filter: 12",
+    ]
+
+
+def test_read_entries_includes_rotated_files(slow_log):
+    slow_log.max_bytes = 200
+    for _ in range(4):
+        slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25, None)
+    assert len(read_entries(slow_log.path)) == 4
+
+
+def test_each_process_writes_its_own_file(slow_log):
+    for pid in (101, 102, 101):
+        with patch('src.api.slowlog.os.getpid', return_value=pid):
+            slow_log.observe(query_strings['user_by_id'], {"user_id": 3}, 1, 0.25, None)
+    log_dir = os.path.dirname(slow_log.path)
+    assert sorted(os.listdir(log_dir)) == ['slow.101.jsonl', 'slow.102.jsonl']
+    with open(os.path.join(log_dir, 'slow.jsonl.txt'), 'w') as other:
+        other.write("not a log\n")
+    assert len(read_entries(slow_log.path)) == 3
+
+
+def test_summarise_orders_by_total_time():
+    entries = [
+        {"query": "user_by_id", "duration_ms": 150.0, "rows": 1},
+        {"query": "products", "duration_ms": 400.0, "rows": 90, "plan": "..."},
+        {"query": "user_by_id", "duration_ms": 350.0, "rows": 1},
+        {"query": "products", "duration_ms": 300.0, "rows": 95},
+    ]
+    summary = summarise(entries)
+    assert [s['query'] for s in summary] == ['products', 'user_by_id']
+    assert summary[0] == {"query": "products", "count": 2, "total_ms": 700.0,
+                          "mean_ms": 350.0, "max_ms": 400.0, "max_rows": 95, "plans": 1}
+
+
+def test_process_query_reports_to_slow_log(app_context):
+    from src.api.routes import process_query
+    with patch('src.api.routes.get_db_connection') as mock_conn, \
+            patch('src.api.routes.slow_query_log') as mock_log:
+        mock_conn().run.return_value = [['a', 'b', 'c']]
+        mock_conn().columns = [{'name': 'id'}, {'name': 'col2'}, {'name': 'col3'}]
+        process_query('test query', user_id=3)
+        query, params, rows, _, connect = mock_log.observe.call_args[0]
+        assert (query, params, rows) == ('test query', {"user_id": 3}, 1)
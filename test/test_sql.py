@@ -0,0 +1,55 @@
+import pytest
+from src.data.sql import projected_query, select_columns, query_strings,\
+    projected_keys, migrations
+
+
+def test_projected_query_defaults_to_all_fields():
+    assert projected_query('products') == query_strings['products']
+    assert projected_query('user_sales', []) == query_strings['user_sales']
+
+
+def test_projected_query_keeps_joins_and_filters():
+    query = projected_query('user_sales', ['product_title'])
+    full = query_strings['user_sales']
+    assert 'SELECT \nproduct_title\nFROM sales s' in query
+    assert query.split('SELECT \n')[0] == full.split('SELECT \n')[0]
+    assert query.split('FROM sales')[1] == full.split('FROM sales')[1]
+
+
+def test_select_columns_uses_select_order_and_ignores_duplicates():
+    assert select_columns('all_users', ['id', 'first_name', 'id']) == ['first_name', 'id']
+
+
+def test_projected_query_rejects_unknown_fields():
+    with pytest.raises(ValueError):
+        projected_query('products', ['id', 'password'])
+
+
+def test_projected_query_registers_key_for_logging():
+    query = projected_query('products', ['title', 'id'])
+    assert projected_keys[query] == 'products[id,title]'
+    assert projected_query('products', ['id', 'title']) is query
+
+
+def test_concurrent_index_builds_run_as_single_statements():
+    for name, migration in migrations.items():
+        steps = [migration] if isinstance(migration, str) else migration
+        for step in steps:
+            if 'CONCURRENTLY' in step:
+                assert isinstance(migration, list), name
+                assert step.count(';') == 1, name
+
+
+def test_product_search_ranks_from_stored_vector():
+    assert 'to_tsvector' not in query_strings['product_search']
+    assert 'p.search_vector @@' in query_strings['product_search']
+
+
+@pytest.mark.parametrize('key,fields,order', [
+    ('products', ['title'], 'order by p.id'),
+    ('all_users', ['first_name'], 'ORDER BY u.id'),
+])
+def test_projection_without_id_keeps_id_order(key, fields, order):
+    query = projected_query(key, fields)
+    assert 'id,' not in query.split('from')[0].lower()
+    assert query.rstrip(';').endswith(order)